@@ -0,0 +1,235 @@
+"""
+Asyncio front end for chinup. This module requires Python 3.6 or later, so it
+isn't imported by the chinup package; import it explicitly:
+
+    from chinup.aio import AsyncChinupBar
+
+    chinup = await AsyncChinupBar(token='XYZ').get('me')
+
+Chinups are queued lazily just as with ChinupBar, and every chinup queued
+before the event loop gets around to syncing is sent in the same batch. The
+batch requests themselves run in the loop's default executor, so the event
+loop is never blocked on the network.
+
+The classes here are based on chinup.chinup, whether or not django-allauth is
+available. For async chinups which accept a user, see chinup.aio_allauth.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import logging
+import time
+import weakref
+
+from .chinup import Chinup, ChinupBar
+from .exceptions import PagingError, QueueTimedOut
+from .queue import ChinupQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+_loop_queues = weakref.WeakKeyDictionary()
+
+
+class AsyncChinupQueue(ChinupQueue):
+    """
+    Queue of pending AsyncChinups with a common app token, per event loop.
+    """
+
+    @classmethod
+    def _get_queues(cls):
+        loop = asyncio.get_event_loop()
+        try:
+            return _loop_queues[loop]
+        except KeyError:
+            qs = _loop_queues[loop] = {}
+            return qs
+
+    def _setup(self):
+        super(AsyncChinupQueue, self)._setup()
+        self._next_flush = None
+        self._next_deadlines = []
+        self._flushing = False
+
+    async def sync(self, caller=None, deadline=None):
+        """
+        Waits for the queue to be flushed. Every coroutine that calls sync()
+        before the flush starts shares the same batches.
+
+        The deadline is an absolute time.time() after which to stop waiting,
+        and defaults to the caller's deadline, if any. The flush itself runs
+        until the latest deadline of the coroutines waiting for it.
+        """
+        if caller and caller.deadline is not None:
+            deadline = min(deadline or caller.deadline, caller.deadline)
+
+        if caller and caller.completed:
+            return
+
+        loop = asyncio.get_event_loop()
+        flush = self._next_flush
+        if flush is None:
+            flush = self._next_flush = loop.create_future()
+            if not self._flushing:
+                loop.call_soon(self._start_flush)
+        self._next_deadlines.append(deadline)
+
+        # Shield the flush so that one canceled waiter doesn't cancel it for
+        # everybody else.
+        try:
+            if deadline is None:
+                await asyncio.shield(flush)
+            else:
+                await asyncio.wait_for(asyncio.shield(flush),
+                                       max(0, deadline - time.time()))
+        except asyncio.TimeoutError:
+            pass
+
+        if caller and not caller.completed:
+            if deadline is not None and deadline <= time.time():
+                caller.exception = QueueTimedOut("Deadline passed before request completed.")
+            else:
+                caller.exception = QueueTimedOut("Couldn't make enough progress to complete request.")
+
+    def _start_flush(self):
+        flush, self._next_flush = self._next_flush, None
+        deadlines, self._next_deadlines = self._next_deadlines, []
+        deadline = (None if None in deadlines or not deadlines
+                    else max(deadlines))
+        self._flushing = True
+        asyncio.ensure_future(self._flush(flush, deadline))
+
+    async def _flush(self, flush, deadline=None):
+        taken = self._take_pending()
+        try:
+            try:
+                # Preparing the chinups might query the database for tokens,
+                # and completing them from the cache might query the cache,
+                # neither of which may block the event loop.
+                loop = asyncio.get_event_loop()
+                chinups, dups, coalesced = await loop.run_in_executor(
+                    None, lambda: self._ready_chinups(self._prepare_taken(taken)))
+                await self._async_sync(chinups, deadline=deadline)
+                failed = self.uncoalesce(coalesced)
+                if failed:
+                    await self._async_sync(failed, deadline=deadline)
+                self._finish_sync(chinups, dups)
+            except BaseException:
+                # Put the unfinished chinups back on the queue, so that they
+                # can be synced again, rather than losing them.
+                with self._lock:
+                    self.chinups.prepend(cu for cu in taken if not cu.completed)
+                raise
+        except asyncio.CancelledError:
+            flush.cancel()
+            raise
+        except Exception as e:
+            flush.set_exception(e)
+        else:
+            flush.set_result(None)
+        finally:
+            self._flushing = False
+            # Chinups that were synced during this flush wait for the next
+            # one, since they might not have been on the queue in time.
+            if self._next_flush is not None:
+                asyncio.get_event_loop().call_soon(self._start_flush)
+
+    async def _async_sync(self, chinups, caller=None, deadline=None):
+        loop = asyncio.get_event_loop()
+        for delay, batches in self._passes(chinups, caller, deadline):
+            if not batches:
+                await asyncio.sleep(delay)
+                continue
+
+            # Send the batches and uploads in the executor, populating the
+            # responses on the event loop as each one returns. If one fails,
+            # the rest are still populated before raising the first error.
+            futures = [loop.run_in_executor(None, send)
+                       for send in self._batch_senders(batches, deadline)]
+            errors = []
+            for future in asyncio.as_completed(futures):
+                try:
+                    batch_chinups, responses = await future
+                except Exception as e:
+                    errors.append(e)
+                else:
+                    self._populate(batch_chinups, responses)
+            if errors:
+                raise errors[0]
+
+
+class AsyncChinup(Chinup):
+    """
+    A Chinup which must be awaited rather than synced implicitly:
+
+        chinup = await bar.get('me')
+        print(chinup['name'])
+
+    Paged responses should be iterated asynchronously:
+
+        async for friend in bar.get('me/friends'):
+            print(friend['name'])
+    """
+    __slots__ = ()
+
+    def __await__(self):
+        return self._await().__await__()
+
+    async def _await(self):
+        await self.sync()
+        return self
+
+    def _sync(self, deadline=None):
+        if not self.completed:
+            raise RuntimeError("{!r} must be awaited before accessing its "
+                               "response".format(self))
+
+    async def _async_sync(self, deadline=None):
+        if not self.completed:
+            await self.queue.sync(self, deadline=deadline)
+
+    async def sync(self, deadline=None):
+        """
+        Forces a sync of this chinup, raising its exception if appropriate.
+
+        The deadline is an absolute time.time() after which the chinup
+        fails with QueueTimedOut rather than waiting longer.
+        """
+        await self._async_sync(deadline)
+        self._maybe_raise_exception()
+
+    async def __aiter__(self):
+        """
+        Asynchronous version of Chinup.__iter__, awaiting successive pages.
+        """
+        await self._async_sync()
+        paging = not isinstance(self.data, dict)
+        chinup = self
+        while chinup:  # will be None on last page
+            await chinup._async_sync()
+            if not isinstance(chinup.data, (dict, list)):
+                if not self.exception:
+                    self.exception = PagingError("Unexpected chinup.data while paging")
+                    self.exception.chinup = chinup
+                self._maybe_raise_exception()
+                break
+            for d in chinup.data:
+                yield d
+            if not paging:
+                break
+            chinup = chinup.next_page()
+
+
+class AsyncChinupBar(ChinupBar):
+    chinup_class = AsyncChinup
+    queue_class = AsyncChinupQueue
+
+    def _query(self, method, path, data, defer, callback, deadline=None):
+        # Nothing can be synced here without blocking the event loop, so
+        # every request is deferred until the chinup is awaited.
+        return super(AsyncChinupBar, self)._query(method, path, data,
+                                                  True, callback, deadline)
+
+
+__all__ = ['AsyncChinup', 'AsyncChinupBar', 'AsyncChinupQueue']
@@ -0,0 +1,25 @@
+"""
+Asyncio front end for chinup with django-allauth, so that AsyncChinupBar
+accepts a user rather than requiring a token:
+
+    from chinup.aio_allauth import AsyncChinupBar
+
+    chinup = await AsyncChinupBar(user=request.user).get('me')
+
+The user tokens are looked up in the executor, along with the rest of
+preparing the batches, so the database isn't queried on the event loop.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from . import aio, allauth
+
+
+class AsyncChinup(aio.AsyncChinup, allauth.Chinup):
+    __slots__ = ()
+
+
+class AsyncChinupBar(aio.AsyncChinupBar, allauth.ChinupBar):
+    chinup_class = AsyncChinup
+
+
+__all__ = ['AsyncChinup', 'AsyncChinupBar']
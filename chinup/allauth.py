@@ -6,6 +6,7 @@ from django.contrib.auth import get_user_model
 from django.db.models import Q
 
 from . import chinup, exceptions
+from .util import basestring
 
 
 class NoSuchUser(exceptions.ChinupError):
@@ -21,6 +22,9 @@ exceptions.MissingToken = MissingToken
 
 
 class Chinup(chinup.Chinup):
+    __slots__ = ('user',)
+
+    _slot_defaults = dict(user=None)
 
     def __init__(self, **kwargs):
         self.user = kwargs.pop('user', None)
@@ -0,0 +1,113 @@
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+import logging
+import pickle
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Bounded in-process cache, supporting the get_many and set_many methods of
+    a Django cache. Values are pickled on the way in, so cached values can't
+    be modified by the caller, and the pickle size is used to enforce
+    max_bytes. The least recently used entries are evicted first.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key: (pickled value, expiry)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                try:
+                    data, expiry = self._entries.pop(key)
+                except KeyError:
+                    continue
+                if expiry is not None and expiry <= now:
+                    self._bytes -= len(data)
+                    continue
+                # Reinsert to mark as most recently used.
+                self._entries[key] = data, expiry
+                found[key] = data
+        return {k: pickle.loads(v) for k, v in found.items()}
+
+    def set_many(self, data, timeout=None):
+        expiry = time.time() + timeout if timeout else None
+        data = {k: pickle.dumps(v, pickle.HIGHEST_PROTOCOL)
+                for k, v in data.items()}
+        with self._lock:
+            for key, value in data.items():
+                self._discard(key)
+                if len(value) > self.max_bytes:
+                    logger.debug("Not caching %s, size %d exceeds max_bytes",
+                                 key, len(value))
+                    continue
+                self._entries[key] = value, expiry
+                self._bytes += len(value)
+            self._evict()
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= len(entry[0])
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self._bytes > self.max_bytes):
+            key, (value, expiry) = self._entries.popitem(last=False)
+            self._bytes -= len(value)
+
+
+class TieredCache(object):
+    """
+    Two-tier cache with a local cache, normally an LRUCache, in front of a
+    shared cache such as Django's. Reads are satisfied by the local tier
+    when possible, and misses that are found in the shared tier are copied
+    to the local tier. Writes go through to both tiers. The timeout is for
+    entries copied from the shared tier, since their original timeout isn't
+    known.
+    """
+    def __init__(self, local, shared, timeout=None):
+        self.local = local
+        self.shared = shared
+        self.timeout = timeout
+
+    def get_many(self, keys):
+        found = self.local.get_many(keys)
+        missing = [k for k in keys if k not in found]
+        if missing:
+            shared = self.shared.get_many(missing)
+            if shared:
+                self.local.set_many(shared, timeout=self.timeout)
+                found.update(shared)
+        return found
+
+    def set_many(self, data, timeout=None):
+        self.local.set_many(data, timeout=timeout)
+        self.shared.set_many(data, timeout=timeout)
+
+
+__all__ = ['LRUCache', 'TieredCache']
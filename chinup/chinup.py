@@ -1,26 +1,112 @@
 from __future__ import absolute_import, unicode_literals
 
-import collections
-import json
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+import hashlib
 import logging
+import threading
 try:
     from urllib.parse import urlencode
 except ImportError:
     from urllib import urlencode
+import weakref
 
 from urlobject import URLObject as URL
 
 from .exceptions import ChinupCanceled, PagingError
 from .lowlevel import parse_fb_exception
+from .packing import PACK_WINDOW, get_packer
 from .queue import ChinupQueue
-from .util import partition, get_modattr, dev_inode, as_json, get_proof
+from .util import (partition, get_modattr, dev_inode, as_json, from_json,
+                   get_proof, basestring)
 from .conf import settings
 
 
 logger = logging.getLogger(__name__)
 
 
-class Chinup(collections.Mapping):
+class ChinupConfig(object):
+    """
+    Settings that are normally shared by all the chinups from a ChinupBar.
+    Instances are interned by ChinupConfig.get, so chinups with the same
+    settings share a single object rather than each holding copies.
+    """
+    __slots__ = ('raise_exceptions', 'prefetch_next_page', 'summary_info',
+                 'migrations', 'app_secret', '__weakref__')
+
+    fields = __slots__[:-1]
+
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, **kwargs):
+        for name in self.fields:
+            setattr(self, name, kwargs[name])
+
+    @classmethod
+    def get(cls, **kwargs):
+        migrations = kwargs['migrations']
+        key = tuple(kwargs[name] if name != 'migrations' else
+                    repr(sorted(migrations.items())) if migrations else None
+                    for name in cls.fields)
+        with cls._lock:
+            config = cls._interned.get(key)
+            if config is None:
+                config = cls._interned[key] = cls(**kwargs)
+            return config
+
+    def replace(self, **kwargs):
+        d = {name: getattr(self, name) for name in self.fields}
+        d.update(kwargs)
+        return self.get(**d)
+
+
+class ChinupRequest(Mapping):
+    """
+    The method, path and data of a chinup, in slots rather than a dict, but
+    read like a dict: chinup.request['path'].
+    """
+    __slots__ = ('method', 'path', 'data')
+
+    def __init__(self, method, path, data):
+        self.method = method
+        self.path = path
+        self.data = data
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, d):
+        self.__init__(**d)
+
+
+def _config_property(name):
+    def fget(self):
+        return getattr(self._config, name)
+
+    def fset(self, value):
+        self._config = self._config.replace(**{name: value})
+
+    return property(fget, fset)
+
+
+class Chinup(Mapping):
     """
     A single FB request/response. This shouldn't be instantiated directly,
     rather the caller should use a ChinupBar:
@@ -45,7 +131,43 @@ class Chinup(collections.Mapping):
             do something clever with d
     """
 
-    def __init__(self, queue, method, path, data, **kwargs):
+    # Slots rather than an instance dict, since there can be very many
+    # chinups. Settings that are usually the same for many chinups are kept
+    # in a shared ChinupConfig.
+    __slots__ = ('queue', 'request', 'token', 'callback', 'deadline',
+                 '_config', '_response', '_exception', '_next_page',
+                 '_undecoded', '_request_dict', '_attempts', '_retry_at',
+                 '_retry_deadline')
+    if not hasattr(Mapping, '__weakref__'):
+        # Python 2's Mapping has no __slots__, so it's weakrefable already.
+        __slots__ += ('__weakref__',)
+
+    # Initial values of slots, which are also the values for slots missing
+    # from a pickle.
+    _slot_defaults = dict(
+        token=None,
+        callback=None,
+        deadline=None,
+        _response=None,
+        _exception=None,
+        _next_page=None,
+        # Set by _set_response until the response body is decoded.
+        _undecoded=False,
+        # Cached by make_request_dict.
+        _request_dict=None,
+        # Retry state, see RetryPolicy.
+        _attempts=0,
+        _retry_at=None,
+        _retry_deadline=None,
+    )
+
+    raise_exceptions = _config_property('raise_exceptions')
+    prefetch_next_page = _config_property('prefetch_next_page')
+    summary_info = _config_property('summary_info')
+    migrations = _config_property('migrations')
+    app_secret = _config_property('app_secret')
+
+    def __init__(self, queue, method, path, data, deadline=None, **kwargs):
         required = ['token', 'raise_exceptions', 'callback',
                     'prefetch_next_page', 'summary_info',
                     'migrations', 'app_secret']
@@ -55,12 +177,14 @@ class Chinup(collections.Mapping):
             raise ValueError("Wrong kwargs: missing={!r}, extra={!r}".format(
                 list(missing), list(extra)))
 
+        self._init_slots()
         self.queue = queue
-        self.request = dict(method=method, path=path, data=data)
-        self._response = None
-        self._exception = None
-        self._next_page = None
-        self.__dict__.update(kwargs)
+        self.request = ChinupRequest(method, path, data)
+        self.deadline = deadline
+        self._config = ChinupConfig.get(
+            **{k: kwargs.pop(k) for k in ChinupConfig.fields})
+        for k, v in kwargs.items():
+            setattr(self, k, v)
 
         # and put it on the queue...
         self.queue.append(self)
@@ -75,6 +199,11 @@ class Chinup(collections.Mapping):
                 '{2}data={0.request[data]} response={1!r}').format(
                     self, r, extra + ' ' if extra else '')
 
+    if str is not bytes:
+        # Python 3
+        def __str__(self):
+            return self.__unicode__()
+
     def __repr__(self):
         return '<{0.__class__.__name__} id={1} {0} >'.format(self, id(self))
 
@@ -87,22 +216,26 @@ class Chinup(collections.Mapping):
         comp = (self._response, self._exception)
         return any(x is not None for x in comp) and comp
 
-    def _sync(self):
+    def _sync(self, deadline=None):
         if not self.completed:
-            self.queue.sync(self)
+            self.queue.sync(self, deadline=deadline)
 
-    def sync(self):
+    def sync(self, deadline=None):
         """
         Forces a sync of this chinup, as accessing .data would do.
         This is especially for chinups with a callback, where the
         caller wants to sync for the sake of triggering the callback.
+
+        The deadline is an absolute time.time() after which the chinup
+        fails with QueueTimedOut rather than waiting longer.
         """
-        self._sync()
+        self._sync(deadline)
         self._maybe_raise_exception()
 
     @property
     def response(self):
         self._sync()
+        self._decode_response()
         return self._response
 
     @response.setter
@@ -112,11 +245,61 @@ class Chinup(collections.Mapping):
     def _set_response(self, response):
         self._response = response
 
+        # Decoding the response body is deferred until something needs it,
+        # since many responses are never read. A callback needs it right
+        # away though, and so does prefetching the next page, if there is
+        # one. Errors are decoded right away too, so that the exception is
+        # set as soon as the chinup is populated.
+        self._undecoded = True
+        if self.callback or self._is_error(response) or (
+                self.prefetch_next_page and self._has_next_link(response)):
+            self._decode_response()
+
+        # If this chinup has an associated callback, call it now. This allows
+        # the caller to chain chinups, for example an async ads report. Don't
+        # use this if you're not sure you need it.
+        if self.callback:
+            try:
+                self.callback(self)
+            except Exception as e:
+                if not self._exception:
+                    self.exception = e
+
+        # Prepare to fetch the next page.
+        if self.prefetch_next_page and not self._undecoded:
+            self.fetch_next_page()
+
+    @staticmethod
+    def _is_error(response):
+        """
+        Returns True if the response is an error, without decoding the body.
+        """
+        return isinstance(response, dict) and response.get('code', 200) != 200
+
+    @staticmethod
+    def _has_next_link(response):
+        """
+        Returns True if the response might include a paging link, without
+        decoding the body.
+        """
+        if not isinstance(response, dict):
+            return False
+        if response.get('body') is None:
+            # Already decoded, for example a duplicate's response.
+            return 'next' in (response.get('paging') or {})
+        return '"next"' in response['body']
+
+    def _decode_response(self):
+        if not self._undecoded:
+            return
+        self._undecoded = False
+        response = self._response
+
         # Decode and promote response body. The body can be None if the HTTP
         # status code isn't 200, for example 302 with a Location header.
         if isinstance(response, dict) and response.get('body') is not None:
             try:
-                body = json.loads(response['body'])
+                body = from_json(response['body'])
             except ValueError as e:
                 if not self._exception:
                     self.exception = e
@@ -135,20 +318,6 @@ class Chinup(collections.Mapping):
         if not self._exception:
             self.exception = parse_fb_exception(response)
 
-        # If this chinup has an associated callback, call it now. This allows
-        # the caller to chain chinups, for example an async ads report. Don't
-        # use this if you're not sure you need it.
-        if self.callback:
-            try:
-                self.callback(self)
-            except Exception as e:
-                if not self._exception:
-                    self.exception = e
-
-        # Prepare to fetch the next page.
-        if self.prefetch_next_page:
-            self.fetch_next_page()
-
     def _response_get(self, name):
         self._maybe_raise_exception()
         if isinstance(self.response, dict):
@@ -168,6 +337,7 @@ class Chinup(collections.Mapping):
     @property
     def exception(self):
         self._sync()
+        self._decode_response()
         return self._exception
 
     @exception.setter
@@ -233,6 +403,7 @@ class Chinup(collections.Mapping):
             prefetch_next_page=self.prefetch_next_page,
             summary_info=False,  # don't force after first page
             migrations=self.migrations,
+            deadline=self.deadline,
         )
 
         # There's no mention of applying appsecret_proof to paging links in the
@@ -265,6 +436,19 @@ class Chinup(collections.Mapping):
 
         For non-paged dict-based responses, yield keys for collections.Mapping.
         """
+        return self._iter_records()
+
+    def stream(self):
+        """
+        Iterates like __iter__, except that each page after the first is
+        released as soon as its records have been yielded, rather than
+        remaining linked from this chinup. Memory use stays at about two
+        pages regardless of the length of the edge. Iterating again fetches
+        the subsequent pages again.
+        """
+        return self._iter_records(release=True)
+
+    def _iter_records(self, release=False):
         paging = not isinstance(self.data, dict)
         chinup = self
         while chinup:  # will be None on last page
@@ -278,7 +462,67 @@ class Chinup(collections.Mapping):
                 yield d
             if not paging:
                 break
-            chinup = chinup.next_page()
+            chinup = chinup._advance(release)
+
+    def _advance(self, release=False):
+        """
+        Returns the next page, unlinking it from this one if release is set,
+        so that it can be freed once the caller is done with it.
+        """
+        next_page = self.next_page()
+        if release:
+            self._next_page = None
+        return next_page
+
+    @classmethod
+    def drain(cls, chinups, release=False):
+        """
+        Iterates over many chinups at once, yielding (chinup, record) for
+        every record of every page, as for iterating each chinup. Rather
+        than draining the chinups one after another, the next pages of all
+        of them are fetched together, and records are yielded as each batch
+        lands:
+
+            for chinup, friend in Chinup.drain(friend_lists):
+                print(chinup.token, friend['name'])
+
+        The chinup in each pair is the one passed in, not the page that the
+        record came from. With release, pages are released as they're
+        consumed, as for stream().
+        """
+        # List of (chinup, current page).
+        pending = [(cu, cu) for cu in chinups]
+
+        while pending:
+            # If nothing is ready, sync the first incomplete page. That sends
+            # it in the first batch along with whatever else is queued,
+            # including the prefetched next pages of the other chinups.
+            if not any(page.completed for _, page in pending):
+                pending[0][1]._sync()
+
+            still_pending = []
+            for chinup, page in pending:
+                if not page.completed:
+                    still_pending.append((chinup, page))
+                    continue
+
+                data = page.data
+                if not isinstance(data, (dict, list)):
+                    if not chinup.exception:
+                        chinup.exception = PagingError("Unexpected chinup.data while paging")
+                        chinup.exception.chinup = page
+                    chinup._maybe_raise_exception()
+                    continue
+
+                for d in data:
+                    yield chinup, d
+
+                if isinstance(data, list):
+                    page = page._advance(release)
+                    if page:
+                        still_pending.append((chinup, page))
+
+            pending = still_pending
 
     def __len__(self):
         """
@@ -306,6 +550,8 @@ class Chinup(collections.Mapping):
         # Prevent truth value testing from calling len(self).
         return True
 
+    __bool__ = __nonzero__
+
     def __getitem__(self, key):
         if isinstance(key, int) and isinstance(self.data, list):
             if key < len(self.data):
@@ -325,8 +571,7 @@ class Chinup(collections.Mapping):
                 logger.debug("__eq__ class mismatch")
             return False
 
-        req, oreq = self._make_eq_dict(), other._make_eq_dict()
-        if req != oreq:
+        if self.fingerprint != other.fingerprint:
             #logger.debug("__eq__ req mismatch")
             return False
 
@@ -334,17 +579,19 @@ class Chinup(collections.Mapping):
             logger.debug("__eq__ raise_exceptions mismatch")
             return False
 
+        self._decode_response()
+        other._decode_response()
         if self.completed != other.completed:
             logger.debug("__eq__ completed mismatch")
             return False
 
         return True
 
-    def _make_eq_dict(self):
+    def _make_eq_dict(self, req=None):
         """
-        Returns a modified request dict suitable for __eq__ and __hash__.
+        Returns a modified request dict suitable for the fingerprint.
         """
-        req = self.make_request_dict()
+        req = dict(req or self.make_request_dict())
         if 'files' in req:
             # Replace {name: file} with {name: (dev, inode)}
             files = {k: dev_inode(f) for k, f in req['files'].items()}
@@ -353,20 +600,89 @@ class Chinup(collections.Mapping):
         return req
 
     def __hash__(self):
-        eq_dict = self._make_eq_dict()
-        return hash(tuple(sorted(eq_dict.items())))
+        return hash(self.fingerprint)
+
+    @property
+    def fingerprint(self):
+        """
+        Returns a compact digest of the request, which is the same for any
+        chinups that would make identical requests. This is computed along
+        with the request dict, and cached with it.
+        """
+        return self._compiled_request()[3]
 
     def items(self):
         return self.data.items()
 
+    @classmethod
+    def _slot_info(cls):
+        """
+        Returns (names, defaults) for the slots of this class and its bases,
+        computed once per class.
+        """
+        info = cls.__dict__.get('_all_slot_info')
+        if info is None:
+            names, defaults = [], {}
+            for c in reversed(cls.__mro__):
+                slots = c.__dict__.get('__slots__', ())
+                if isinstance(slots, basestring):
+                    slots = (slots,)
+                names.extend(s for s in slots
+                             if s not in ('__weakref__', '__dict__'))
+                defaults.update(c.__dict__.get('_slot_defaults', {}))
+            info = tuple(names), defaults
+            setattr(cls, '_all_slot_info', info)
+        return info
+
+    def _init_slots(self):
+        # Subclasses may set their own slots before calling __init__, so
+        # don't overwrite those.
+        for k, v in self._slot_info()[1].items():
+            if not hasattr(self, k):
+                setattr(self, k, v)
+
+    # Slots which aren't carried over by _clone.
+    _unclonable = ('callback', 'deadline', '_response', '_exception',
+                   '_next_page', '_undecoded', '_request_dict', '_attempts',
+                   '_retry_at', '_retry_deadline')
+
+    def _clone(self, method, path, data):
+        """
+        Returns a copy of this chinup for a different request, with the same
+        token and config, but no callback, deadline or response. The copy
+        isn't put on the queue.
+        """
+        clone = self.__class__.__new__(self.__class__)
+        clone._init_slots()
+        for name in self._slot_info()[0]:
+            if name not in self._unclonable and hasattr(self, name):
+                setattr(clone, name, getattr(self, name))
+        clone.request = ChinupRequest(method, path, data)
+        return clone
+
     def __getstate__(self):
         if self.callback and self.completed:
             self.callback = None
         assert not self.callback, "can't pickle chinup with callback"
-        return self.__dict__
+        d = dict(getattr(self, '__dict__', {}))
+        for name in self._slot_info()[0]:
+            if hasattr(self, name):
+                d[name] = getattr(self, name)
+        d.pop('_request_dict', None)
+        # Store the config as plain attributes, as before slots.
+        config = d.pop('_config')
+        d.update((name, getattr(config, name)) for name in config.fields)
+        return d
 
     def __setstate__(self, d):
-        self.__dict__.update(d)
+        d = dict(d)
+        if isinstance(d.get('request'), dict):
+            d['request'] = ChinupRequest(**d['request'])
+        self._init_slots()
+        self._config = ChinupConfig.get(
+            **{k: d.pop(k) for k in ChinupConfig.fields})
+        for k, v in d.items():
+            setattr(self, k, v)
 
         # Put it back on the current queue for app_token. This means it will be
         # considered for completion, but will be ignored if self.completed.
@@ -375,7 +691,32 @@ class Chinup(collections.Mapping):
     def make_request_dict(self):
         """
         Returns a dict suitable for a single request in a batch.
+
+        The dict is compiled once and cached, until something it depends on
+        changes, such as the token being set by prepare_batch. A copy is
+        returned, since the caller might modify it.
+        """
+        return dict(self._compiled_request()[2])
+
+    def _compiled_request(self):
+        """
+        Returns the cached tuple of (key, data, request dict, fingerprint),
+        recompiling it if necessary.
         """
+        data = self.request['data']
+        key = (self.request['method'], self.request['path'], self.token,
+               self.app_secret, self.summary_info, self.migrations,
+               settings.RELATIVE_URL_HOOK)
+        cached = self._request_dict
+        if not (cached and cached[0] == key and cached[1] is data):
+            req = self._compile_request_dict()
+            eq_items = sorted(self._make_eq_dict(req).items())
+            fingerprint = hashlib.md5(
+                repr(eq_items).encode('utf-8')).digest()
+            cached = self._request_dict = (key, data, req, fingerprint)
+        return cached
+
+    def _compile_request_dict(self):
         method = self.request['method']
         relative_url = URL(self.request['path'])
         data = self.request['data'] or {}
@@ -452,7 +793,23 @@ class Chinup(collections.Mapping):
         """
         # Build request dicts for the first 50 chinups, limit imposed by the
         # Facebook API.
-        requests = [c.make_request_dict() for c in chinups[:50]]
+        if not settings.ADAPTIVE_BATCHING:
+            requests = [c.make_request_dict() for c in chinups[:50]]
+
+        # Or let the packer choose from a window of the queue, to fill the
+        # batch according to the expected cost of each request. The chosen
+        # chinups are moved to the front.
+        elif chinups:
+            window = chinups[:PACK_WINDOW]
+            candidates = [c.make_request_dict() for c in window]
+            indexes = get_packer().pack(candidates)
+            chosen = set(indexes)
+            requests = [candidates[i] for i in indexes]
+            chinups = ([window[i] for i in indexes] +
+                       [c for i, c in enumerate(window) if i not in chosen] +
+                       chinups[PACK_WINDOW:])
+        else:
+            requests = []
 
         # Return the full list of chinups and the possibly shorter list of
         # requests.  Note the requests still match one-to-one with the chinups
@@ -497,7 +854,7 @@ class ChinupBar(object):
             self.chinup_class = get_modattr(self.chinup_class)
         return self.chinup_class(**kwargs)
 
-    def _query(self, method, path, data, defer, callback):
+    def _query(self, method, path, data, defer, callback, deadline=None):
         if self.api_version:
             path = '{}/{}'.format(self.api_version, path.lstrip('/'))
 
@@ -510,7 +867,8 @@ class ChinupBar(object):
                                   callback=callback,
                                   prefetch_next_page=self.prefetch_next_page,
                                   summary_info=self.summary_info,
-                                  migrations=self.migrations)
+                                  migrations=self.migrations,
+                                  deadline=deadline)
 
         if not defer:
             queue.sync(chinup)
@@ -522,20 +880,22 @@ class ChinupBar(object):
 
         return chinup
 
-    def get(self, path, data=None, defer=True, callback=None):
-        return self._query('GET', path, data, defer, callback)
+    def get(self, path, data=None, defer=True, callback=None, deadline=None):
+        return self._query('GET', path, data, defer, callback, deadline)
 
-    def post(self, path, data, defer=False, callback=None):
-        return self._query('POST', path, data, defer, callback)
+    def post(self, path, data, defer=False, callback=None, deadline=None):
+        return self._query('POST', path, data, defer, callback, deadline)
 
-    def put(self, path, data, defer=False, callback=None):
-        return self._query('PUT', path, data, defer, callback)
+    def put(self, path, data, defer=False, callback=None, deadline=None):
+        return self._query('PUT', path, data, defer, callback, deadline)
 
-    def delete(self, path, data=None, defer=False, callback=None):
-        return self._query('DELETE', path, data, defer, callback)
+    def delete(self, path, data=None, defer=False, callback=None,
+               deadline=None):
+        return self._query('DELETE', path, data, defer, callback, deadline)
 
-    def debug_token(self, path='debug_token', data=None, defer=True):
-        return self._query('DEBUG_TOKEN', path, data, defer, None)
+    def debug_token(self, path='debug_token', data=None, defer=True,
+                    deadline=None):
+        return self._query('DEBUG_TOKEN', path, data, defer, None, deadline)
 
     def __getstate__(self):
         return self.__dict__
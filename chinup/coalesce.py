@@ -0,0 +1,154 @@
+"""
+Coalescing of GET requests for the same node which differ only in their
+fields, such as:
+
+    GET 123?fields=name
+    GET 123?fields=picture,category
+
+into a single request for the union of the fields, 123?fields=name,picture,
+category. The response is then projected back to the fields that each of
+the original requests asked for.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+import re
+
+from urlobject import URLObject as URL
+
+from .util import basestring, unicode
+
+
+# Fields which are in the response whether requested or not.
+IMPLICIT_FIELDS = ('id',)
+
+_version_segment = re.compile(r'^v\d+\.\d+$')
+_alias = re.compile(r'\.as\(([^)]*)\)')
+
+
+def split_fields(value):
+    """
+    Splits a fields parameter on the commas which aren't nested in field
+    expansions or modifiers, for example "name,posts.limit(5){message,from}"
+    gives ["name", "posts.limit(5){message,from}"].
+    """
+    fields, depth, start = [], 0, 0
+    for i, c in enumerate(value):
+        if c in '({':
+            depth += 1
+        elif c in ')}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            fields.append(value[start:i].strip())
+            start = i + 1
+    fields.append(value[start:].strip())
+    return [f for f in fields if f]
+
+
+def field_key(field):
+    """
+    Returns the key of the field in the response, which is its name or its
+    alias, for example "picture" for "picture.type(large)", or "pic" for
+    "picture.as(pic)".
+    """
+    head = field.split('{', 1)[0]
+    m = _alias.search(head)
+    if m:
+        return m.group(1)
+    return re.match(r'[^.{(]*', field).group(0)
+
+
+def requested_fields(chinup):
+    """
+    Returns the list of fields requested by a chinup, or None if it doesn't
+    name its fields.
+    """
+    fields = (chinup.request['data'] or {}).get('fields')
+    if fields is None:
+        fields = URL(chinup.request['path']).query_dict.get('fields')
+    if fields is None:
+        return None
+    if isinstance(fields, basestring):
+        fields = split_fields(fields)
+    elif isinstance(fields, (list, tuple)):
+        fields = [f for v in fields for f in split_fields(unicode(v))]
+    else:
+        return None
+    return fields or None
+
+
+def coalesce_key(chinup):
+    """
+    Returns a key which is the same for chinups that can be coalesced, or
+    None if the chinup can't be coalesced with any other. Only GETs of a
+    single node are coalesced, since the fields of an edge apply to every
+    page of its data.
+    """
+    if (chinup.completed or chinup.request['method'] != 'GET' or
+            chinup._retry_at is not None):
+        return None
+
+    url = URL(chinup.make_request_dict()['relative_url'])
+    segments = [s for s in url.path.split('/') if s]
+    if segments and _version_segment.match(segments[0]):
+        segments = segments[1:]
+    if len(segments) != 1:
+        return None
+
+    params = tuple(sorted((k, tuple(v))
+                          for k, v in url.query_multi_dict.items()
+                          if k != 'fields'))
+    return (chinup.__class__, unicode(url.path), params)
+
+
+class FieldUnion(object):
+    """
+    The union of the fields of coalesced requests, by response key. Fields
+    with the same key but different modifiers, such as picture.type(large)
+    and picture.type(small), can't be coalesced.
+    """
+    def __init__(self):
+        self.fields = OrderedDict()
+
+    def add(self, fields):
+        """
+        Adds the fields to the union and returns True, or returns False
+        without changing the union if they conflict with it.
+        """
+        keyed = [(field_key(f), f) for f in fields]
+        if any(self.fields.get(k, f) != f for k, f in keyed):
+            return False
+        for k, f in keyed:
+            self.fields.setdefault(k, f)
+        return True
+
+    def __unicode__(self):
+        return ','.join(self.fields.values())
+
+    if str is not bytes:
+        # Python 3
+        def __str__(self):
+            return self.__unicode__()
+
+
+def merged_request(chinup, union):
+    """
+    Returns (path, data) for the chinup's request, but for the union of
+    fields rather than its own.
+    """
+    path = unicode(URL(chinup.request['path']).del_query_param('fields'))
+    data = dict(chinup.request['data'] or {}, fields=unicode(union))
+    return path, data
+
+
+def project(data, fields):
+    """
+    Returns the node data with only the requested fields.
+    """
+    keys = set(field_key(f) for f in fields)
+    keys.update(IMPLICIT_FIELDS)
+    return {k: v for k, v in data.items() if k in keys}
+
+
+__all__ = ['FieldUnion', 'coalesce_key', 'field_key', 'merged_request',
+           'project', 'requested_fields', 'split_fields']
@@ -1,6 +1,6 @@
 from __future__ import absolute_import, unicode_literals
 
-from .util import get_modattr
+from .util import basestring, get_modattr
 
 
 class Settings(object):
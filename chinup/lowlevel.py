@@ -1,22 +1,34 @@
 from __future__ import absolute_import, unicode_literals
 
-from decimal import Decimal
+from collections import OrderedDict
+import codecs
 import hashlib
 import imghdr
-import json
+import itertools
 import logging
 import mimetypes
 import os
+import re
 import sys
+import threading
+import zlib
+try:
+    from urllib.parse import parse_qsl
+except ImportError:
+    from urlparse import parse_qsl
 
 import requests
-from requests.utils import guess_filename
+from requests.adapters import HTTPAdapter
+from requests.utils import guess_filename, super_len
 from urlobject import URLObject as URL
 
+from .cache import LRUCache, TieredCache
 from .conf import settings
 from .exceptions import (FacebookFail, BatchFacebookFail, FacebookError,
                          OAuthError, TransportError, ChinupError)
-from .util import as_json
+from .multipart import MultipartStream
+from .throttle import get_throttle
+from .util import as_json, basestring, from_json
 
 
 logger = logging.getLogger(__name__)
@@ -24,9 +36,96 @@ logger = logging.getLogger(__name__)
 
 batches = []
 
-def batch_request(app_token, reqs, appsecret_proof=None, url=None):
+
+# Size of the chunks read from the connection with settings.STREAM_RESPONSES.
+STREAM_CHUNK_SIZE = 65536
+
+
+# How long to cache etagged responses.
+ETAGS_TIMEOUT = 86400  # one day
+
+# Response headers kept in responses after batch processing, and in cached
+# etags entries, lowercase.
+KEPT_HEADERS = ('etag', 'content-type', 'location')
+
+ETAGS_COMPRESS_LEVEL = 6
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the process-wide requests session used for batch requests.
+    The session holds a pool of keep-alive connections to the Graph API which
+    is shared by all threads. It's rebuilt on first use after a fork, so that
+    child processes never share sockets with their parent.
+    """
+    global _session, _session_pid, _session_lock
+    pid = os.getpid()
+    if _session_pid != pid:
+        # The lock might have been held by another thread at the moment of
+        # fork, in which case it will never be released in the child.
+        if _session_pid is not None:
+            _session_lock = threading.Lock()
+        with _session_lock:
+            if _session_pid != pid:
+                _session = make_session()
+                _session_pid = pid
+    return _session
+
+
+def make_session():
+    """
+    Returns a new requests session configured according to
+    settings.HTTP_POOL_SIZE and settings.HTTP_KEEPALIVE.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not settings.HTTP_KEEPALIVE:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def reset_session():
+    """
+    Closes the pooled connections and forgets the session, so the next batch
+    request starts afresh.
+    """
+    global _session, _session_pid
+    session, pid = _session, _session_pid
+    _session = _session_pid = None
+    # Don't close connections inherited from the parent process, since they
+    # still belong to the parent.
+    if session is not None and pid == os.getpid():
+        session.close()
+
+
+def _after_fork():
+    global _session_lock, _local_etags_cache
+    _session_lock = threading.Lock()
+    _local_etags_cache = None
+    reset_session()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def batch_request(app_token, reqs, appsecret_proof=None, url=None,
+                  on_response=None, timeout=None):
     """
     Runs a batch request to the Facebook API.
+
+    The timeout is a (connect, read) tuple in seconds as for requests,
+    defaulting to settings.CONNECT_TIMEOUT and settings.READ_TIMEOUT.
+
+    With settings.STREAM_RESPONSES, the responses are parsed as they're read
+    from the connection, and on_response(index, response) is called for each
+    one as soon as it's available, excepting timeouts.
     """
     required_keys = set(['method', 'relative_url'])
     assert all(required_keys <= set(r) for r in reqs)
@@ -61,6 +160,11 @@ def batch_request(app_token, reqs, appsecret_proof=None, url=None):
     # Upgrade files to tuples with content-type.
     files = {k: file_tuple(f, k) for k, f in files.items()}
 
+    # Take note of the requests for the response cache, before etags
+    # headers are added.
+    if settings.RESPONSE_CACHE_TTLS:
+        cache_reqs = [dict(r) for r in reqs]
+
     # Add etags headers.
     if settings.ETAGS:
         edicts = add_etags(reqs, app_token)
@@ -70,36 +174,79 @@ def batch_request(app_token, reqs, appsecret_proof=None, url=None):
     if settings.DEBUG or settings.TESTING:
         batches.append(reqs)
 
-    # Post the batch request. Always include headers, for
-    #  1. 302 location header on biz picture image,
-    #  2. etags support,
-    #  3. debugging.
+    # Post the batch request. Facebook includes headers in the responses
+    # unless told not to, so only ask for them when they're needed.
     data = dict(access_token=app_token,
                 batch=as_json(reqs),
-                include_headers='true')
+                include_headers='true' if include_headers(reqs) else 'false')
     if appsecret_proof:
         data['appsecret_proof'] = appsecret_proof
+    stream = settings.STREAM_RESPONSES
+    if timeout is None:
+        timeout = (settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT)
+
+    # Note where the attachments start, to rewind them after sending.
+    positions = file_positions(files)
+
+    # Stream the multipart body rather than letting requests build it in
+    # memory, so large attachments are read in chunks as they're sent.
+    headers = None
+    if files and settings.STREAM_UPLOADS:
+        data = MultipartStream(data, files)
+        headers = {'Content-Type': data.content_type}
+        files = None
+
     try:
-        r = requests.post(url, data=data, files=files)
+        r = get_session().post(url, data=data, files=files, headers=headers,
+                               stream=stream, timeout=timeout)
     except requests.RequestException as e:
         raise TransportError(e)
+    finally:
+        rewind(positions)
 
-    # Attempt to parse before checking HTTP status, because
-    # parse_fb_response() will raise an exception for Facebook enumerated
-    # error responses.
-    try:
-        resps = parse_fb_response(r)
-    except ChinupError as e:
-        e.__class__ = e._lowlevel_class
-        raise
-    if r.status_code != 200:
-        raise BatchFacebookFail(repr(resps), code=r.status_code)
-    if not isinstance(resps, list):
-        raise BatchFacebookFail('Not a list: {!r}'.format(resps), code=200)
-
-    # Handle etags in responses.
-    if settings.ETAGS:
-        resps = handle_etags(resps, edicts)
+    if stream and r.status_code == 200:
+        try:
+            resps = stream_responses(r, edicts if settings.ETAGS else None,
+                                     on_response)
+        except ChinupError as e:
+            # Raise e rather than re-raising, since Python 2 would re-raise
+            # the original class.
+            e.__class__ = e._lowlevel_class
+            raise e
+        except requests.RequestException as e:
+            raise TransportError(e)
+        finally:
+            r.close()
+
+    else:
+        # Attempt to parse before checking HTTP status, because
+        # parse_fb_response() will raise an exception for Facebook enumerated
+        # error responses.
+        try:
+            resps = parse_fb_response(r)
+        except ChinupError as e:
+            e.__class__ = e._lowlevel_class
+            raise e
+        if r.status_code != 200:
+            raise BatchFacebookFail(repr(resps), code=r.status_code)
+        if not isinstance(resps, list):
+            raise BatchFacebookFail('Not a list: {!r}'.format(resps), code=200)
+
+        # Handle etags in responses.
+        if settings.ETAGS:
+            resps = handle_etags(resps, edicts)
+
+    # Record usage reported by Facebook, for throttling.
+    if settings.THROTTLE:
+        get_throttle().usage.observe(app_token, r.headers, reqs, resps)
+
+    # Drop the headers that nothing needs now.
+    if not settings.DEBUG_HEADERS:
+        strip_headers(resps)
+
+    # Save fresh responses in the response cache.
+    if settings.RESPONSE_CACHE_TTLS:
+        cache_responses(cache_reqs, resps, app_token)
 
     # Check for a timeout, unambiguously represented by null in the JSON,
     # or None when decoded.
@@ -111,10 +258,121 @@ def batch_request(app_token, reqs, appsecret_proof=None, url=None):
     return resps
 
 
+def upload_request(app_token, req, appsecret_proof=None, url=None,
+                   timeout=None):
+    """
+    Sends a single request with attached files directly rather than in a
+    batch, to settings.UPLOAD_URL for a video or settings.GRAPH_URL otherwise
+    by default. Returns a response dict in the same form as a response in a
+    batch.
+
+    The files are sent with their own names, such as "source", unlike in a
+    batch where they can only be referred to by attached_files.
+    """
+    assert req['method'] == 'POST'
+    if not url:
+        url = settings.UPLOAD_URL if is_video_upload(req) else settings.GRAPH_URL
+    url = '{}/{}'.format(url.rstrip('/'),
+                         req['relative_url'].lstrip('/'))
+    if settings.MIGRATIONS:
+        url = URL(url).set_query_params(
+            migrations_override=as_json(settings.MIGRATIONS))
+
+    data = OrderedDict(parse_qsl(req.get('body', ''), keep_blank_values=True))
+    if 'access_token' not in URL(url).query_dict:
+        data['access_token'] = app_token
+        if appsecret_proof:
+            data['appsecret_proof'] = appsecret_proof
+    files = {k: file_tuple(f, k) for k, f in req.get('files', {}).items()}
+    if timeout is None:
+        timeout = (settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT)
+
+    # Save the request in debug mode for inspection, as a batch of one.
+    if settings.DEBUG or settings.TESTING:
+        batches.append([req])
+
+    positions = file_positions(files)
+    headers = None
+    if settings.STREAM_UPLOADS:
+        data = MultipartStream(data, files)
+        headers = {'Content-Type': data.content_type}
+        files = None
+
+    try:
+        r = get_session().post(url, data=data, files=files, headers=headers,
+                               timeout=timeout)
+    except requests.RequestException as e:
+        raise TransportError(e)
+    finally:
+        rewind(positions)
+
+    resp = dict(
+        code=r.status_code,
+        headers=[dict(name=k, value=v) for k, v in r.headers.items()],
+        body=r.content.decode('utf-8'),
+    )
+
+    # Record usage reported by Facebook, for throttling. App usage counts
+    # against the app as for a batch, and the rest against the request.
+    if settings.THROTTLE:
+        get_throttle().usage.observe(
+            app_token, {'x-app-usage': r.headers.get('x-app-usage')},
+            [req], [resp])
+
+    if not settings.DEBUG_HEADERS:
+        strip_headers([resp])
+
+    return resp
+
+
+def is_video_upload(req):
+    """
+    Returns True if the request uploads a video, either to a videos edge or
+    with a video attached.
+    """
+    files = req.get('files')
+    if not files or req['method'] != 'POST':
+        return False
+    if req['relative_url'].split('?', 1)[0].endswith('/videos'):
+        return True
+    for k, f in files.items():
+        ft = file_tuple(f, k, image=False)[2]
+        if ft and ft.startswith('video/'):
+            return True
+    return False
+
+
+def is_heavy_upload(req):
+    """
+    Returns True if the request should be sent by upload_request rather
+    than in a batch, because it has a video attached, or attachments
+    totalling settings.UPLOAD_SPLIT_BYTES or more.
+    """
+    files = req.get('files')
+    if not files or req['method'] != 'POST':
+        return False
+    if is_video_upload(req):
+        return True
+    size = 0
+    for k, f in files.items():
+        try:
+            size += super_len(file_tuple(f, k, image=False)[1])
+        except Exception:
+            pass
+    return size >= settings.UPLOAD_SPLIT_BYTES
+
+
 def parse_fb_response(response):
-    data = response.content.decode('utf-8')
+    return parse_fb_content(response.content.decode('utf-8'))
+
+
+def _parse_json(s):
+    return from_json(s, decimal=settings.JSON_DECIMAL)
+
+
+def parse_fb_content(data):
     try:
-        data = json.loads(data, parse_float=Decimal)
+        data = _parse_json(data)
     except ValueError:
         pass
     else:
@@ -124,6 +382,117 @@ def parse_fb_response(response):
     return data
 
 
+def stream_responses(response, edicts=None, on_response=None):
+    """
+    Returns the list of responses in a batch, parsing each one as soon as
+    it's read from the HTTP response and passing it to on_response. Handles
+    etags along the way if edicts is provided.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = itertools.chain(
+        (decoder.decode(c) for c in response.iter_content(STREAM_CHUNK_SIZE)),
+        [decoder.decode(b'', final=True)])
+
+    # Facebook returns a JSON array, unless there was an error for the batch
+    # as a whole. In that case, fall back to parsing the entire thing.
+    first = next((c for c in chunks if c.strip()), '')
+    if not first.lstrip().startswith('['):
+        data = parse_fb_content(first + ''.join(chunks))
+        raise BatchFacebookFail('Not a list: {!r}'.format(data), code=200)
+
+    resps = []
+    to_cache = {}
+    try:
+        for resp in iter_json_array(itertools.chain([first], chunks),
+                                    loads=_parse_json):
+            if edicts is not None:
+                resp = handle_etag(resp, edicts[len(resps)], to_cache)
+            if on_response and resp is not None:
+                on_response(len(resps), resp)
+            resps.append(resp)
+    except ValueError as e:
+        raise BatchFacebookFail('Malformed response: {}'.format(e), code=200)
+
+    if edicts is not None:
+        cache_etags(to_cache)
+
+    return resps
+
+
+_json_string_special = re.compile(r'["\\]')
+_json_structural = re.compile(r'["\[\]{},]')
+
+
+def iter_json_array(chunks, loads=from_json):
+    """
+    Incrementally parses a JSON array from an iterable of text chunks,
+    yielding each element as soon as it's complete. Only the text of the
+    current element is kept in memory. Raises ValueError if the text isn't a
+    complete JSON array.
+    """
+    parts = []
+    depth = 0
+    in_string = escaped = done = False
+
+    for chunk in chunks:
+        pos, end = 0, len(chunk)
+
+        if depth == 0:
+            # Look for the opening bracket.
+            pos = end - len(chunk.lstrip())
+            if pos == end:
+                continue
+            if chunk[pos] != '[':
+                raise ValueError("Not a JSON array")
+            depth, pos = 1, pos + 1
+        start = pos
+
+        while pos < end:
+            if escaped:
+                escaped, pos = False, pos + 1
+                continue
+
+            if in_string:
+                m = _json_string_special.search(chunk, pos)
+                if not m:
+                    break
+                pos = m.end()
+                if m.group() == '\\':
+                    escaped = True
+                else:
+                    in_string = False
+                continue
+
+            m = _json_structural.search(chunk, pos)
+            if not m:
+                break
+            pos, c = m.end(), m.group()
+            if c == '"':
+                in_string = True
+            elif c in '[{':
+                depth += 1
+            elif depth > 1:
+                if c != ',':
+                    depth -= 1
+            else:
+                # End of an element, or of the array itself.
+                parts.append(chunk[start:m.start()])
+                element = ''.join(parts).strip()
+                parts, start = [], pos
+                if element or c == ',':
+                    yield loads(element)
+                if c == ']':
+                    done = True
+                    break
+
+        if done:
+            break
+        parts.append(chunk[start:])
+
+    if not done:
+        raise ValueError("Unterminated JSON array")
+
+
 def parse_fb_exception(data):
     if data is False:
         return FacebookError("Facebook returned false")
@@ -186,6 +555,31 @@ def file_tuple(f, default_name=None, image=True):
     return fn, fp, ft, fh
 
 
+def file_positions(files):
+    """
+    Returns a list of (fileobj, position) for the attachments, which are
+    tuples as returned by file_tuple, so that they can be rewound after
+    they're sent. The request can then be sent again, for example when it's
+    retried.
+    """
+    positions = []
+    for fn, fp, ft, fh in files.values():
+        if hasattr(fp, 'read'):
+            try:
+                positions.append((fp, fp.tell()))
+            except (AttributeError, IOError, OSError):
+                pass
+    return positions
+
+
+def rewind(positions):
+    for fp, position in positions:
+        try:
+            fp.seek(position)
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+
+
 def add_etags(requests, app_token):
     """
     Returns a list of dicts like this:
@@ -203,15 +597,17 @@ def add_etags(requests, app_token):
     The list of dicts (edicts) is passed back to caller, so it can be reused by
     handle_etags below.
     """
-    cache = settings.CACHE
-    edicts = [dict(request=r, key=etags_cache_key(r, app_token))
+    cache = get_etags_cache()
+    edicts = [dict(request=r, key=(etags_cache_key(r, app_token)
+                                   if use_etags(r) else None))
               for r in requests]
+    keys = [e['key'] for e in edicts if e['key']]
     if cache:
-        responses = cache.get_many([e['key'] for e in edicts])
+        responses = cache.get_many(keys) if keys else {}
     else:
         logger.warning("Chinup ETAGS=True but CACHE=%r", cache)
         responses = {}
-    edicts = [dict(e, responses=responses.get(e['key'], []))
+    edicts = [dict(e, responses=decode_etags_entry(responses.get(e['key'])))
               for e in edicts]
 
     for edict in edicts:
@@ -234,56 +630,234 @@ def handle_etags(responses, edicts):
     # new_responses will be truncated.
     assert len(edicts) >= len(responses)
 
-    new_responses = []
     to_cache = {}
+    new_responses = [handle_etag(response, edict, to_cache)
+                     for response, edict in zip(responses, edicts)]
+    cache_etags(to_cache)
 
-    for response, edict in zip(responses, edicts):
-        if isinstance(response, dict) and 'headers' in response:
-            # Check for an etag in the response (whether 304 or 200).
-            etag = next((h['value'] for h in response['headers']
-                         if h['name'].lower() == 'etag'), None)
-
-            # Check for a 304 response, look for matching etag.
-            if response['code'] == 304:
-                if etag:
-                    assert edict['responses']
-                    response = next(r for e, r in edict['responses'] if e == etag)
-                else:
-                    assert len(edict['responses']) == 1
-                    etag, response = edict['responses'][0]
+    assert len(new_responses) == len(responses)
+    return new_responses
 
-                logger.debug("Got 304 etag=%s, replacing with %s",
-                             etag, response['code'])
 
-            # Promote this etag to front of cache list for this request.
+def handle_etag(response, edict, to_cache):
+    """
+    Restores the cached response for a 304, and adds a new etagged response
+    to the to_cache dict. Returns the new response.
+    """
+    if edict['key'] and isinstance(response, dict) and 'headers' in response:
+        # Check for an etag in the response (whether 304 or 200).
+        etag = next((h['value'] for h in response['headers']
+                     if h['name'].lower() == 'etag'), None)
+
+        # Check for a 304 response, look for matching etag.
+        if response['code'] == 304:
             if etag:
-                resps = [(etag, response)]
-                resps.extend((e, r) for e, r in edict['responses'] if e != etag)
-                # Facebook should return an ETag header with a 304
-                # response, but it does not. This means we can't actually cache
-                # more than one response per request at a time, which is
-                # annoying but probably fine.
-                resps = resps[:1]
-                to_cache[edict['key']] = resps
-
-        new_responses.append(response)
-
-    # Update cached etags.
-    cache = settings.CACHE
+                assert edict['responses']
+                response = next(r for e, r in edict['responses'] if e == etag)
+            else:
+                assert len(edict['responses']) == 1
+                etag, response = edict['responses'][0]
+
+            logger.debug("Got 304 etag=%s, replacing with %s",
+                         etag, response['code'])
+
+        # Promote this etag to front of cache list for this request, unless
+        # it's there already, which saves a write to the cache for every 304.
+        cached = edict['responses']
+        if etag and not (cached and cached[0][0] == etag):
+            resps = [(etag, response)]
+            resps.extend((e, r) for e, r in edict['responses'] if e != etag)
+            # Facebook should return an ETag header with a 304
+            # response, but it does not. This means we can't actually cache
+            # more than one response per request at a time, which is
+            # annoying but probably fine.
+            resps = resps[:1]
+            entry = encode_etags_entry(resps)
+            if entry is not None:
+                to_cache[edict['key']] = entry
+
+    return response
+
+
+def encode_etags_entry(resps):
+    """
+    Returns the compact form of a list of (etag, response) for the cache, or
+    None if it's too big to cache according to settings.ETAGS_MAX_ENTRY_BYTES.
+    Response headers are stripped to KEPT_HEADERS, then the list is
+    serialized to JSON and compressed. Response bodies are JSON text, so they
+    typically compress very well.
+    """
+    resps = [(etag, _strip_headers(r)) for etag, r in resps]
+    entry = zlib.compress(as_json(resps).encode('utf-8'), ETAGS_COMPRESS_LEVEL)
+    if len(entry) > settings.ETAGS_MAX_ENTRY_BYTES:
+        logger.debug("Not caching etags entry of %d bytes", len(entry))
+        return None
+    return entry
+
+
+def decode_etags_entry(entry):
+    """
+    Returns the list of (etag, response) from a cache entry made by
+    encode_etags_entry. Entries cached by older versions of chinup as a plain
+    list are returned as-is, and entries that can't be decoded are treated as
+    a miss.
+    """
+    if not entry:
+        return []
+    if isinstance(entry, list):
+        return entry
+    try:
+        return [tuple(x) for x in from_json(zlib.decompress(entry).decode('utf-8'))]
+    except (zlib.error, ValueError, TypeError) as e:
+        logger.warning("Ignoring undecodable etags entry: %s", e)
+        return []
+
+
+def _strip_headers(response):
+    if isinstance(response, dict) and response.get('headers'):
+        response = dict(response, headers=[
+            h for h in response['headers']
+            if h['name'].lower() in KEPT_HEADERS])
+    return response
+
+
+def strip_headers(responses):
+    """
+    Strips the headers of the responses in place to KEPT_HEADERS, leaving
+    out the headers key entirely when there's nothing to keep.
+    """
+    for response in responses:
+        if isinstance(response, dict) and 'headers' in response:
+            headers = [h for h in response['headers'] or ()
+                       if h['name'].lower() in KEPT_HEADERS]
+            if headers:
+                response['headers'] = headers
+            else:
+                del response['headers']
+
+
+def include_headers(requests):
+    """
+    Returns True if the responses to the requests need their headers,
+    according to settings.INCLUDE_HEADERS. By default, headers are included
+    for debugging, throttling, requests taking part in etags handling, and
+    requests with a path matching settings.INCLUDE_HEADERS_PATHS, such as
+    images which respond with a redirect.
+    """
+    if settings.INCLUDE_HEADERS is not None:
+        return settings.INCLUDE_HEADERS
+    if settings.DEBUG_HEADERS or settings.THROTTLE:
+        return True
+    if settings.ETAGS and settings.CACHE and any(use_etags(r) for r in requests):
+        return True
+    paths = settings.INCLUDE_HEADERS_PATHS
+    return any(re.search(p, r['relative_url'].split('?', 1)[0])
+               for r in requests for p in paths)
+
+
+def cache_etags(to_cache):
+    """
+    Updates cached etags with the dict built by handle_etag.
+    """
+    cache = get_etags_cache()
     if cache:
-        cache.set_many(to_cache, timeout=86400)  # one day
+        if to_cache:
+            cache.set_many(to_cache, timeout=ETAGS_TIMEOUT)
     else:
         logger.warning("Chinup ETAGS=True but CACHE=%r", cache)
 
-    assert len(new_responses) == len(responses)
-    return new_responses
+
+def use_etags(request):
+    """
+    Returns True if the request should take part in etag handling, according
+    to settings.ETAGS_METHODS and settings.ETAGS_PATHS.
+    """
+    if request['method'] not in settings.ETAGS_METHODS:
+        return False
+    paths = settings.ETAGS_PATHS
+    if paths is None:
+        return True
+    path = request['relative_url'].split('?', 1)[0]
+    return any(re.search(p, path) for p in paths)
+
+
+_local_etags_cache = None
+
+
+def get_etags_cache():
+    """
+    Returns the cache for etags, which is settings.CACHE with an in-process
+    LRU tier in front of it, unless settings.ETAGS_LOCAL_ENTRIES is zero.
+    """
+    global _local_etags_cache
+    cache = settings.CACHE
+    if not cache or not settings.ETAGS_LOCAL_ENTRIES:
+        return cache
+    local = _local_etags_cache
+    if local is None:
+        local = _local_etags_cache = LRUCache(
+            max_entries=settings.ETAGS_LOCAL_ENTRIES,
+            max_bytes=settings.ETAGS_LOCAL_BYTES)
+    return TieredCache(local, cache, timeout=ETAGS_TIMEOUT)
 
 
-def etags_cache_key(request, app_token):
+def etags_cache_key(request, app_token, prefix='chinup.etags.'):
     assert all(isinstance(k, basestring) for k in request.keys())
     assert all(isinstance(v, basestring) for v in request.values())
-    m = hashlib.md5(repr(sorted(request.items())))
-    m.update(app_token)
-    key = 'chinup.etags.' + m.hexdigest()
+    m = hashlib.md5(repr(sorted(request.items())).encode('utf-8'))
+    m.update(app_token.encode('utf-8'))
+    key = prefix + m.hexdigest()
     assert len(key) <= 250
     return key
+
+
+def response_cache_ttl(request):
+    """
+    Returns the number of seconds to cache the response to the request,
+    according to settings.RESPONSE_CACHE_TTLS, or None if it shouldn't be
+    cached.
+    """
+    if request['method'] != 'GET' or 'headers' in request:
+        return None
+    path = request['relative_url'].split('?', 1)[0]
+    for pattern, ttl in settings.RESPONSE_CACHE_TTLS:
+        if re.search(pattern, path):
+            return ttl
+    return None
+
+
+def response_cache_key(request, app_token):
+    return etags_cache_key(request, app_token, prefix='chinup.responses.')
+
+
+def get_cached_responses(requests, app_token):
+    """
+    Returns a list of cached responses corresponding to the requests, with
+    None for requests which aren't cached.
+    """
+    cache = settings.CACHE
+    keys = [response_cache_key(r, app_token) if response_cache_ttl(r) else None
+            for r in requests]
+    if not cache or not any(keys):
+        return [None] * len(requests)
+    cached = cache.get_many([k for k in keys if k])
+    return [cached.get(k) if k else None for k in keys]
+
+
+def cache_responses(requests, responses, app_token):
+    """
+    Caches successful responses to the requests according to
+    settings.RESPONSE_CACHE_TTLS. The requests must not have been modified
+    by add_etags yet, so the keys match get_cached_responses.
+    """
+    cache = settings.CACHE
+    if not cache:
+        return
+    by_ttl = {}
+    for request, response in zip(requests, responses):
+        ttl = response_cache_ttl(request)
+        if ttl and isinstance(response, dict) and response.get('code') == 200:
+            key = response_cache_key(request, app_token)
+            by_ttl.setdefault(ttl, {})[key] = response
+    for ttl, to_cache in by_ttl.items():
+        cache.set_many(to_cache, timeout=ttl)
@@ -0,0 +1,136 @@
+from __future__ import absolute_import, unicode_literals
+
+import binascii
+import os
+
+from requests.utils import super_len
+
+from .util import unicode
+
+
+# Size of the chunks read from attached files.
+CHUNK_SIZE = 65536
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return unicode(value).encode('utf-8')
+
+
+def _quote(value):
+    # As browsers do, per the HTML5 spec for multipart/form-data.
+    value = _to_bytes(value)
+    for c, escaped in ((b'"', b'%22'), (b'\r', b'%0D'), (b'\n', b'%0A')):
+        value = value.replace(c, escaped)
+    return value
+
+
+class MultipartStream(object):
+    """
+    A multipart/form-data body which reads attached files in chunks as it's
+    sent, rather than building the whole body in memory as requests does.
+    Pass it as the data for a request, along with its content_type:
+
+        body = MultipartStream(data, files)
+        session.post(url, data=body,
+                     headers={'Content-Type': body.content_type})
+
+    The length is known up front, so the request has a Content-Length rather
+    than being chunked. The files are tuples of (filename, fileobj or
+    content, content type, headers) as returned by file_tuple. File objects
+    are read from their current position, which is restored if the body is
+    read again, for example when a request is retried.
+    """
+    def __init__(self, fields, files, boundary=None, chunk_size=CHUNK_SIZE):
+        self.boundary = boundary or binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.chunk_size = chunk_size
+        self._parts = []  # bytes or (fileobj, offset, length)
+        self._iter = None
+        self._chunk = b''
+        self._pos = 0
+
+        for name, value in sorted(fields.items()):
+            self._parts.append(self._header(name) + b'\r\n' +
+                               _to_bytes(value) + b'\r\n')
+
+        for name, (fn, fp, ft, fh) in sorted(files.items()):
+            header = self._header(name, fn)
+            if ft:
+                header += b'Content-Type: ' + _to_bytes(ft) + b'\r\n'
+            for k, v in sorted((fh or {}).items()):
+                header += _to_bytes(k) + b': ' + _to_bytes(v) + b'\r\n'
+            self._parts.append(header + b'\r\n')
+            if hasattr(fp, 'read'):
+                try:
+                    offset = fp.tell()
+                except (AttributeError, IOError, OSError):
+                    offset = None
+                self._parts.append((fp, offset, super_len(fp)))
+            else:
+                self._parts.append(_to_bytes(fp))
+            self._parts.append(b'\r\n')
+
+        self._parts.append(b'--' + _to_bytes(self.boundary) + b'--\r\n')
+
+        self.len = sum(p[2] if isinstance(p, tuple) else len(p)
+                       for p in self._parts)
+
+    def _header(self, name, filename=None):
+        header = (b'--' + _to_bytes(self.boundary) + b'\r\n' +
+                  b'Content-Disposition: form-data; name="' + _quote(name) + b'"')
+        if filename:
+            header += b'; filename="' + _quote(filename) + b'"'
+        return header + b'\r\n'
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        """
+        Yields the body in chunks, starting from the beginning.
+        """
+        for part in self._parts:
+            if not isinstance(part, tuple):
+                yield part
+                continue
+            fp, offset, length = part
+            if offset is not None:
+                fp.seek(offset)
+            while length > 0:
+                chunk = fp.read(min(self.chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield _to_bytes(chunk)
+
+    def read(self, size=-1):
+        """
+        File-like read, so that the body is sent as it's read.
+        """
+        if self._iter is None:
+            self._iter = iter(self)
+
+        pieces = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self._pos >= len(self._chunk):
+                try:
+                    self._chunk, self._pos = next(self._iter), 0
+                except StopIteration:
+                    self._chunk, self._pos = b'', 0
+                    break
+            end = len(self._chunk) if wanted is None else self._pos + wanted
+            piece = self._chunk[self._pos:end]
+            self._pos += len(piece)
+            pieces.append(piece)
+            if wanted is not None:
+                wanted -= len(piece)
+        return b''.join(pieces)
+
+
+__all__ = ['MultipartStream']
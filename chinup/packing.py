@@ -0,0 +1,181 @@
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import threading
+
+from requests.utils import super_len
+
+from .conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# Limit imposed by the Facebook API.
+MAX_BATCH_SIZE = 50
+
+# How far into the queue the packer looks for requests that fit.
+PACK_WINDOW = 4 * MAX_BATCH_SIZE
+
+# Number of endpoints to keep statistics for, least recently seen are
+# forgotten first.
+MAX_ENDPOINTS = 1000
+
+# Weight of the latest observation in the moving averages.
+EWMA_ALPHA = 0.2
+
+# Path segments that identify a node rather than an endpoint, such as
+# 12345, 12345_67890 or act_12345.
+_id_segment = re.compile(r'^(act_)?\d+(_\d+)?$')
+_version_segment = re.compile(r'^v\d+\.\d+$')
+
+
+class EndpointStats(object):
+    """
+    Moving averages of the latency and timeout rate observed for requests to
+    one endpoint.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.timeout_rate = 0.0
+
+    def observe(self, latency, timed_out):
+        self.latency += EWMA_ALPHA * (latency - self.latency)
+        self.timeout_rate += EWMA_ALPHA * (float(timed_out) - self.timeout_rate)
+
+
+class BatchPacker(object):
+    """
+    Sizes batches to finish within a time budget, using the latency and
+    timeout rate learned per endpoint from previous batches, and to stay
+    within a payload size including attachments. The overall batch size
+    limit is halved whenever a batch has timeouts, and grows back gradually
+    as batches succeed.
+
+    Endpoints are identified by method and path with node ids and the API
+    version removed, for example "GET {id}/insights".
+    """
+    def __init__(self, budget, max_bytes, max_size=MAX_BATCH_SIZE):
+        self.budget = budget
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.limit = max_size
+        self.default_latency = float(budget) / max_size
+        self._stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint(request):
+        path = request['relative_url'].split('?', 1)[0]
+        segments = [s for s in path.split('/') if s]
+        if segments and _version_segment.match(segments[0]):
+            segments = segments[1:]
+        segments = ['{id}' if _id_segment.match(s) else s for s in segments]
+        return '{} {}'.format(request['method'], '/'.join(segments))
+
+    @staticmethod
+    def payload_size(request):
+        size = len(request['relative_url']) + len(request.get('body', ''))
+        for f in request.get('files', {}).values():
+            try:
+                size += super_len(f)
+            except Exception:
+                pass
+        return size
+
+    def cost(self, request):
+        """
+        Returns the expected time in seconds that the request adds to a
+        batch, inflated by its timeout rate.
+        """
+        with self._lock:
+            stats = self._stats.get(self.endpoint(request))
+            if not stats:
+                return self.default_latency
+            return stats.latency / (1.0 - min(stats.timeout_rate, 0.9))
+
+    def pack(self, requests):
+        """
+        Returns the indexes of the requests to send in the next batch, in
+        order. The first request is always included so the batch makes
+        progress, then the rest are added first-fit, so that expensive
+        requests that don't fit leave room for cheaper ones behind them.
+        """
+        with self._lock:
+            limit = self.limit
+        indexes = [0]
+        time = self.cost(requests[0])
+        size = self.payload_size(requests[0])
+        for i, request in enumerate(requests[1:], 1):
+            if len(indexes) >= limit:
+                break
+            c, s = self.cost(request), self.payload_size(request)
+            if time + c <= self.budget and size + s <= self.max_bytes:
+                indexes.append(i)
+                time += c
+                size += s
+        return indexes
+
+    def observe(self, requests, responses, elapsed):
+        """
+        Updates the statistics from a batch which took elapsed seconds. The
+        time is shared between the requests in proportion to their expected
+        cost, since Facebook doesn't report the time for each request.
+        """
+        costs = [self.cost(r) for r in requests]
+        total = sum(costs) or 1.0
+        timeouts = 0
+        with self._lock:
+            for request, response, c in zip(requests, responses, costs):
+                timed_out = response is None
+                timeouts += timed_out
+                key = self.endpoint(request)
+                stats = self._stats.pop(key, None)
+                if stats is None:
+                    stats = EndpointStats(self.default_latency)
+                stats.observe(elapsed * c / total, timed_out)
+                self._stats[key] = stats
+            while len(self._stats) > MAX_ENDPOINTS:
+                self._stats.popitem(last=False)
+
+            if timeouts:
+                self.limit = max(1, len(requests) // 2)
+            elif len(requests) >= self.limit:
+                self.limit = min(self.max_size,
+                                 self.limit + max(1, self.limit // 4))
+
+        logger.debug("Observed batch len=%s elapsed=%.2f timeouts=%s limit=%s",
+                     len(requests), elapsed, timeouts, self.limit)
+
+
+_packer = None
+_packer_lock = threading.Lock()
+
+
+def get_packer():
+    """
+    Returns the process-wide BatchPacker, so that what is learned is shared by
+    all the queues.
+    """
+    global _packer
+    with _packer_lock:
+        if _packer is None:
+            _packer = BatchPacker(budget=settings.BATCH_TIME_BUDGET,
+                                  max_bytes=settings.BATCH_MAX_BYTES)
+        return _packer
+
+
+def _after_fork():
+    global _packer_lock
+    _packer_lock = threading.Lock()
+    if _packer is not None:
+        _packer._lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+__all__ = ['BatchPacker', 'get_packer']
@@ -1,10 +1,20 @@
 from __future__ import absolute_import, unicode_literals
 
 from collections import OrderedDict
+from functools import partial
 import logging
+from multiprocessing.pool import ThreadPool
 import threading
-
-from .lowlevel import batch_request
+import time
+
+from .coalesce import (FieldUnion, coalesce_key, merged_request, project,
+                       requested_fields)
+from .exceptions import BatchError, QueueTimedOut
+from .lowlevel import (batch_request, get_cached_responses, is_heavy_upload,
+                       upload_request)
+from .packing import get_packer
+from .retry import RetryPolicy, is_waiting
+from .throttle import get_throttle
 from .conf import settings
 from .util import get_proof
 
@@ -15,23 +25,146 @@ logger = logging.getLogger(__name__)
 _threadlocals = threading.local()
 
 
+_shared_queues = {}
+
+
+class PendingChinups(object):
+    """
+    Ordered collection of pending chinups, with constant-time membership,
+    append and removal by identity. An index by fingerprint is built on first
+    use of find(), then maintained as chinups are added and removed.
+    """
+    def __init__(self, chinups=()):
+        self._chinups = OrderedDict()
+        self._index = self._indexed = None
+        self.extend(chinups)
+
+    def __len__(self):
+        return len(self._chinups)
+
+    def __iter__(self):
+        return iter(list(self._chinups.values()))
+
+    def __contains__(self, chinup):
+        return id(chinup) in self._chinups
+
+    def append(self, chinup):
+        self._chinups[id(chinup)] = chinup
+        if self._index is not None:
+            self._index_add(chinup)
+
+    def extend(self, chinups):
+        for chinup in chinups:
+            self.append(chinup)
+
+    def prepend(self, chinups):
+        """
+        Puts the chinups at the front, in order. This is linear in the total
+        length, but is only done once per sync.
+        """
+        items = OrderedDict((id(c), c) for c in chinups)
+        if self._index is not None:
+            for c in items.values():
+                if id(c) not in self._chinups:
+                    self._index_add(c)
+        items.update(self._chinups)
+        self._chinups = items
+
+    def discard(self, chinup):
+        if self._chinups.pop(id(chinup), None) is not None:
+            if self._index is not None:
+                self._index_discard(chinup)
+
+    def find(self, fingerprint):
+        """
+        Returns a list of the chinups with the given fingerprint.
+        """
+        if self._index is None:
+            self._index, self._indexed = {}, {}
+            for c in self._chinups.values():
+                self._index_add(c)
+        # The fingerprint of a chinup can change after it's indexed, for
+        # example when prepare_batch sets the token, so verify it.
+        return [c for c in self._index.get(fingerprint, {}).values()
+                if self._fingerprint(c) == fingerprint]
+
+    def _index_add(self, chinup):
+        fingerprint = self._fingerprint(chinup)
+        if fingerprint is not None:
+            self._index.setdefault(fingerprint, OrderedDict())[id(chinup)] = chinup
+            self._indexed[id(chinup)] = fingerprint
+
+    def _index_discard(self, chinup):
+        fingerprint = self._indexed.pop(id(chinup), None)
+        if fingerprint is not None:
+            chinups = self._index[fingerprint]
+            del chinups[id(chinup)]
+            if not chinups:
+                del self._index[fingerprint]
+
+    @staticmethod
+    def _fingerprint(chinup):
+        try:
+            return chinup.fingerprint
+        except ValueError:
+            # The request can't be made yet, for example debug_token
+            # without a token.
+            return None
+
+
 class ChinupQueue(object):
     """
     List of pending Chinups with a common app token.
     """
     def __new__(cls, app_token, **kwargs):
-        try:
-            qs = _threadlocals.chinup_queues
-        except AttributeError:
-            qs = _threadlocals.chinup_queues = {}
+        qs = cls._get_queues()
         try:
             q = qs[app_token]
         except KeyError:
-            q = qs[app_token] = super(ChinupQueue, cls).__new__(
-                cls, app_token, **kwargs)
-            q.chinups = []
+            q = super(ChinupQueue, cls).__new__(cls)
+            q._setup()
+            # setdefault is atomic, in case another thread is racing to
+            # create the shared queue.
+            q = qs.setdefault(app_token, q)
         return q
 
+    @classmethod
+    def _get_queues(cls):
+        """
+        Returns the dict of queues indexed by app token, which is per-thread
+        unless settings.SHARED_QUEUE is set.
+        """
+        if settings.SHARED_QUEUE:
+            return _shared_queues
+        try:
+            return _threadlocals.chinup_queues
+        except AttributeError:
+            qs = _threadlocals.chinup_queues = {}
+            return qs
+
+    def _setup(self):
+        """
+        Initializes a new queue. This is called only once for each per-token
+        singleton, unlike __init__.
+        """
+        self.chinups = PendingChinups()
+
+        # Chinups taken off the queue by a sync that's still running, by id,
+        # with the (event, thread) of that sync. The event is set when the
+        # sync finishes. This only matters with settings.SHARED_QUEUE, where
+        # several threads sync the same queue.
+        self._in_flight = {}
+
+        # The same for the GETs taken off the queue, by fingerprint, so that
+        # an identical GET queued in the meantime waits for the response
+        # rather than being sent again.
+        self._in_flight_gets = {}
+
+        # The lock protects self.chinups and the in-flight dicts. It isn't held
+        # while syncing, and is reentrant since a chinup callback might
+        # access the data of another chinup.
+        self._lock = threading.RLock()
+
     def __init__(self, app_token, app_secret=None):
         self.app_token = app_token
         self.appsecret_proof = (get_proof(key=app_secret, msg=app_token)
@@ -47,101 +180,587 @@ class ChinupQueue(object):
         Adds chinup to the queue.
         """
         logger.debug("Queuing %r", chinup)
-        self.chinups.append(chinup)
+        with self._lock:
+            self.chinups.append(chinup)
 
-    def sync(self, caller=None):
+    def sync(self, caller=None, deadline=None):
         """
         Builds and sends batch request, then populates Chinup responses.
+
+        The deadline is an absolute time.time() by which to give up, and
+        defaults to the caller's deadline, if any.
         """
-        if caller:
-            assert caller in self.chinups
+        if caller and caller.deadline is not None:
+            deadline = min(deadline or caller.deadline, caller.deadline)
+
+        # With a shared queue, another thread might be syncing the caller
+        # already, or an identical GET whose response will be shared with
+        # it. Wait for that sync to finish, then check again, since it might
+        # have stopped before completing the caller.
+        while True:
+            with self._lock:
+                if caller and caller.completed:
+                    return
+                flight = caller and self._flight_of(caller)
+                if not flight or flight[1] is threading.current_thread():
+                    taken, flight = self._take_in_flight(caller)
+                    break
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            if not flight[0].wait(timeout):
+                with self._lock:
+                    if not caller.completed:
+                        self.chinups.discard(caller)
+                        caller.exception = QueueTimedOut("Deadline passed before request completed.")
+                return
 
+        try:
+            chinups, dups, coalesced = self._ready_chinups(
+                self._prepare_taken(taken))
+            self._sync(chinups, self._representative(caller, dups, coalesced),
+                       deadline)
+
+            # If a coalesced request failed, send the requests it replaced
+            # separately, so that one bad field doesn't fail the others.
+            failed = self.uncoalesce(coalesced)
+            if failed:
+                self._sync(failed, self._representative(caller, dups), deadline)
+
+            self._finish_sync(chinups, dups, caller, deadline)
+
+        except BaseException:
+            # Put the unfinished chinups back on the queue, so that they can
+            # be synced again, rather than losing them.
+            with self._lock:
+                self.chinups.prepend(cu for cu in taken if not cu.completed)
+            raise
+
+        finally:
+            with self._lock:
+                for cu in taken:
+                    if self._in_flight.get(id(cu)) is flight:
+                        del self._in_flight[id(cu)]
+                for fingerprint, f in list(self._in_flight_gets.items()):
+                    if f is flight:
+                        del self._in_flight_gets[fingerprint]
+            flight[0].set()
+
+    def _flight_of(self, caller):
+        """
+        Returns the (event, thread) of the sync that will complete the
+        caller, either because the caller is in flight or because it's a
+        pending GET which is identical to one in flight, or None. Call with
+        self._lock held.
+        """
+        flight = self._in_flight.get(id(caller))
+        if (flight is None and caller.request['method'] == 'GET' and
+                caller in self.chinups):
+            fingerprint = PendingChinups._fingerprint(caller)
+            if fingerprint is not None:
+                flight = self._in_flight_gets.get(fingerprint)
+        return flight
+
+    def _take_in_flight(self, caller=None):
+        """
+        Takes the pending chinups from the queue for a sync on this thread,
+        marking them in flight. Returns (chinups, flight) where flight is the
+        (event, thread) of the sync. Call with self._lock held.
+        """
+        # The caller might not be pending, for example if it's in flight in
+        # an outer sync on this thread, which is running the callback that
+        # called this sync. Sync it along with the rest.
+        taken = [caller] if caller and caller not in self.chinups else []
+        taken.extend(self.chinups)
+        self.chinups = PendingChinups()
+
+        flight = (threading.Event(), threading.current_thread())
+        for cu in taken:
+            self._in_flight.setdefault(id(cu), flight)
+            if cu.request['method'] == 'GET' and not cu.completed:
+                fingerprint = PendingChinups._fingerprint(cu)
+                if fingerprint is not None:
+                    self._in_flight_gets.setdefault(fingerprint, flight)
+        return taken, flight
+
+    def _representative(self, caller, dups, coalesced=None):
+        """
+        Returns the chinup that will actually be sent on behalf of the caller,
+        which is the first of its duplicates, or the coalesced chinup that
+        replaced that.
+        """
+        if caller and dups:
+            clist = dups.get(self._dedup_key(caller), ())
+            if any(cu is caller for cu in clist):
+                caller = clist[0]
+        if caller and coalesced:
+            for clist in coalesced:
+                if any(cu is caller for cu in clist[1:]):
+                    return clist[0]
+        return caller
+
+    def _take_pending(self):
+        """
+        Takes the pending chinups from the queue, for a sync which doesn't
+        need to mark them in flight.
+        """
         # Take the existing queue from self.chinups. This is the max we will
         # try to accomplish in this sync, even if more are added during
         # processing (this can happen in chinup callback, or for paged
         # responses).
-        chinups, self.chinups = self.chinups, []
+        with self._lock:
+            chinups, self.chinups = list(self.chinups), PendingChinups()
+        return chinups
 
+    @staticmethod
+    def _prepare_taken(chinups):
         # Run prepare_batch() over the entire queue once before starting on
         # batches. This is an opportunity to replace users with tokens the most
         # efficiently, for example.
         if chinups:
             chinups, _ =  chinups[0].prepare_batch(chinups)
+        return chinups
 
+    def _ready_chinups(self, chinups):
+        """
+        Readies the chinups taken from the queue for batching, by
+        deduplicating, completing from the cache and coalescing them.
+        Returns (chinups, dups, coalesced) where dups is for passing to
+        _finish_sync, and coalesced for passing to uncoalesce.
+        """
         # Deduplicate to get the list of unique chinups.
         if settings.DEDUP:
             chinups, dups = self.dedup(chinups)
         else:
             dups = None
 
-        self._sync(chinups, caller)
-
+        # Complete chinups from the response cache, so they don't take a
+        # place in a batch. They're still returned to _finish_sync via dups.
+        if settings.RESPONSE_CACHE_TTLS:
+            if self._complete_from_cache(chinups):
+                if dups is None:
+                    dups = OrderedDict((id(cu), [cu]) for cu in chinups)
+                chinups = [cu for cu in chinups if not cu.completed]
+
+        # Coalesce GETs of the same node that differ only in their fields.
+        # The chinups they replace are returned to _finish_sync via dups.
+        coalesced = []
+        if settings.COALESCE_FIELDS:
+            uniques, coalesced = self.coalesce(chinups)
+            if coalesced:
+                if dups is None:
+                    dups = OrderedDict((id(cu), [cu]) for cu in chinups)
+                chinups = uniques
+
+        return chinups, dups, coalesced
+
+    def _complete_from_cache(self, chinups):
+        """
+        Populates cached responses into chinups. Returns the number of
+        chinups completed.
+        """
+        chinups = [cu for cu in chinups if not cu.completed and
+                   cu.request['method'] == 'GET']
+        if not chinups:
+            return 0
+        responses = get_cached_responses(
+            [cu.make_request_dict() for cu in chinups], self.app_token)
+        count = 0
+        for cu, r in zip(chinups, responses):
+            if r is not None:
+                logger.debug("Cached response for %r", cu)
+                cu.response = r
+                count += 1
+        return count
+
+    def _finish_sync(self, chinups, dups, caller=None, deadline=None):
+        """
+        Distributes responses to duplicates and puts incomplete chinups back
+        on the queue.
+        """
         # Reduplicate the responses into the dups.
         if dups:
             chinups = self.redup(chinups, dups)
 
+        # Give up on the caller if the sync's deadline passed, and on any
+        # chinups that have passed their own deadline.
+        now = time.time()
+        for cu in chinups:
+            if cu is caller and deadline is not None:
+                expired = deadline <= now
+            else:
+                expired = cu.deadline is not None and cu.deadline <= now
+            if expired and not cu.completed:
+                cu.exception = QueueTimedOut("Deadline passed before request completed.")
+
         if caller and not caller.completed:
             # Ugh, this means we timed out without making progress.
             caller.exception = QueueTimedOut("Couldn't make enough progress to complete request.")
 
-        # Drop completed chinups from the queue to prevent clogging with
-        # completed chinups. Put them on the front of the queue, rather than
-        # replacing it entirely, in case there were callbacks (in the response
-        # setter) that added to self.chinups.
-        self.chinups[:0] = [cu for cu in chinups if not cu.completed]
+        with self._lock:
+            # Other threads might have queued identical requests while these
+            # were in flight. Satisfy them with the same responses.
+            if settings.SHARED_QUEUE:
+                self._share_responses(chinups)
+
+            # Drop completed chinups from the queue to prevent clogging with
+            # completed chinups. Put them on the front of the queue, rather
+            # than replacing it entirely, in case there were callbacks (in the
+            # response setter) that added to self.chinups.
+            self.chinups.prepend(cu for cu in chinups if not cu.completed)
 
-    def _sync(self, chinups, caller):
+    def _share_responses(self, chinups):
+        """
+        Populates responses from the completed GET chinups into identical
+        chinups that were queued in the meantime, then drops the latter from
+        the queue.
+        """
+        completed = {}
+        for cu in chinups:
+            if (cu.request['method'] == 'GET' and cu.completed and
+                    cu._response is not None):
+                completed.setdefault(cu.fingerprint, cu)
+        if not completed:
+            return
+
+        for fingerprint, leader in completed.items():
+            for cu in self.chinups.find(fingerprint):
+                if cu.request['method'] == 'GET' and not cu.completed:
+                    logger.debug("Sharing response of %r", leader)
+                    cu.response = self._copy_response(leader._response)
+                    self.chinups.discard(cu)
+
+    def _sync(self, chinups, caller, deadline=None):
+        for delay, batches in self._passes(chinups, caller, deadline):
+            if not batches:
+                time.sleep(delay)
+                continue
+
+            # Make the batch requests, populating responses into chinups as
+            # each batch returns.
+            for batch_chinups, responses in self._send_batches(batches, deadline):
+                self._populate(batch_chinups, responses)
+
+    def _passes(self, chinups, caller, deadline=None):
+        """
+        Plans the passes of a sync, yielding (delay, batches) for each one.
+        The batches should be sent and their responses populated, or if
+        there are none, the delay slept, before resuming the generator.
+        This is shared by the threaded and the asyncio queues, which only
+        differ in how they send and sleep.
+        """
         # Some requests in the batch might time out rather than completing.
         # Continue batching until the calling chinup is satisfied, or until we
-        # stop making progress.
+        # stop making progress or reach the deadline.
         progress = 1
 
         while chinups and progress and not (caller and caller.completed):
+            if deadline is not None and time.time() >= deadline:
+                logger.debug("Deadline passed with %d chinups pending",
+                             len(chinups))
+                break
 
-            # Ask the first chinup to process the chinups into a list of
-            # request dicts. This is a classmethod, but calling via the first
-            # chinup doesn't require us to know if Chinup has been subclassed.
-            chinups, requests = chinups[0].prepare_batch(chinups)
+            # The caller is waiting, so make sure it goes in the first batch
+            # rather than behind everything else that's queued.
+            chinups = self._prioritize(chinups, caller)
+
+            # Chinups waiting to be retried sit out until they're due. If
+            # that's all of them, there's nothing to do but wait.
+            ready, waiting = self._partition_waiting(chinups)
+            if not ready:
+                wake = min(cu._retry_at for cu in waiting)
+                if deadline is not None:
+                    wake = min(wake, deadline)
+                yield max(0, wake - time.time()), None
+                continue
+
+            ready, batches = self._prepare_batches(ready)
+            chinups = ready + waiting
 
             # It's possible that prepare_batch() decided all the chinups
             # were invalid, so make sure that we actually have requests.
-            if not requests:
-                assert not chinups
+            if not batches:
+                assert not ready
                 logger.debug("No requests in batch after calling make_request_dicts()")
                 break
 
-            # Make the batch request.
-            assert len(requests) <= 50
-            logger.log(logging.INFO if settings.DEBUG_REQUESTS else logging.DEBUG,
-                       "Making batch request len=%s/%s queue=%s",
-                       len(requests), len(chinups), id(self))
-            responses = batch_request(self.app_token, requests,
-                                      appsecret_proof=self.appsecret_proof)
-
-            # Populate responses into chinups.
-            for cu, r in zip(chinups, responses):
-                # Don't set response for timeouts, so they'll be automatically
-                # tried again when .data is accessed.
-                if r is not None:
-                    cu.response = r
-                logger.log(logging.INFO if settings.DEBUG_REQUESTS else logging.DEBUG,
-                           '%s%r', 'TIMEOUT ' if r is None else '', cu)
+            sent = [cu for batch_chinups, _ in batches for cu in batch_chinups]
+            yield 0, batches
 
-            # Check for progress.
-            progress = sum(1 for cu in chinups if cu.completed)
+            # Check for progress. Chinups scheduled for a retry count, since
+            # they'll be sent again.
+            progress = sum(1 for cu in sent
+                           if cu.completed or cu._retry_at is not None)
 
             # Filter out the completed chinups for the next pass.
             chinups = [cu for cu in chinups if not cu.completed]
 
+    @staticmethod
+    def _partition_waiting(chinups):
+        """
+        Returns (ready, waiting) where the latter are the chinups scheduled
+        for a retry that isn't due yet.
+        """
+        now = time.time()
+        ready, waiting = [], []
+        for cu in chinups:
+            (waiting if is_waiting(cu, now) else ready).append(cu)
+        return ready, waiting
+
+    @staticmethod
+    def _prioritize(chinups, caller):
+        """
+        Returns the list of chinups with the caller moved to the front.
+        """
+        if caller and chinups and chinups[0] is not caller:
+            for i, cu in enumerate(chinups):
+                if cu is caller:
+                    return [cu] + chinups[:i] + chinups[i+1:]
+        return chinups
+
+    def _prepare_batches(self, chinups):
+        """
+        Returns a tuple of (chinups, batches) where batches is a list of
+        (chinups, requests) tuples for this pass. Normally that's a single
+        batch, but with settings.CONCURRENT_BATCHES the entire queue is split
+        into as many batches as it needs.
+        """
+        batches = []
+        rest = chinups
+
+        while rest:
+            # Ask the first chinup to process the chinups into a list of
+            # request dicts. This is a classmethod, but calling via the first
+            # chinup doesn't require us to know if Chinup has been subclassed.
+            rest, requests = rest[0].prepare_batch(rest)
+            if not requests:
+                assert not rest
+                break
+
+            if not batches:
+                # The first call might have weeded out some chinups.
+                chinups = rest
+            batches.append((rest[:len(requests)], requests))
+            rest = rest[len(requests):]
+
+            if settings.CONCURRENT_BATCHES <= 1:
+                break
+
+        if len(batches) > 1:
+            chinups = [cu for batch_chinups, _ in batches for cu in batch_chinups]
+
+        return chinups, batches
+
+    def _send_batches(self, batches, deadline=None):
+        """
+        Sends the batches, yielding (chinups, responses) as each one returns.
+        Multiple batches are sent concurrently on a thread pool bounded by
+        settings.CONCURRENT_BATCHES.
+
+        With settings.SPLIT_UPLOADS, heavy uploads are taken out of the
+        batches and sent directly on their own thread pool, bounded by
+        settings.UPLOAD_CONCURRENCY, alongside the batches.
+        """
+        uploads = []
+        if settings.SPLIT_UPLOADS:
+            batches, uploads = self._split_uploads(batches)
+
+        upload_pool = upload_results = None
+        if uploads:
+            upload_pool = ThreadPool(min(settings.UPLOAD_CONCURRENCY,
+                                         len(uploads)))
+            upload_results = upload_pool.imap_unordered(
+                partial(_capture, partial(self._send_upload, deadline=deadline)),
+                uploads)
+
+        # If a batch fails, the others are still in flight, and some of them
+        # might have been delivered already. Let them all finish and yield
+        # their responses before raising the first error, so that chinups
+        # which were sent aren't put back on the queue to be sent again.
+        errors = []
+        try:
+            if len(batches) == 1:
+                result, error = _capture(
+                    partial(self._send_batch, populate=True, deadline=deadline),
+                    batches[0])
+                if error is None:
+                    yield result
+                else:
+                    errors.append(error)
+            elif batches:
+                pool = ThreadPool(min(settings.CONCURRENT_BATCHES, len(batches)))
+                send = partial(_capture,
+                               partial(self._send_batch, deadline=deadline))
+                try:
+                    for result, error in pool.imap_unordered(send, batches):
+                        if error is None:
+                            yield result
+                        else:
+                            errors.append(error)
+                finally:
+                    pool.terminate()
+
+            if upload_results:
+                for result, error in upload_results:
+                    if error is None:
+                        yield result
+                    else:
+                        errors.append(error)
+        finally:
+            if upload_pool:
+                upload_pool.terminate()
+
+        if errors:
+            raise errors[0]
+
+    def _batch_senders(self, batches, deadline=None):
+        """
+        Returns a list of callables which each send one of the batches, or
+        with settings.SPLIT_UPLOADS, one of the heavy uploads taken out of
+        them, returning (chinups, responses). This is for sending on an
+        executor rather than with _send_batches.
+        """
+        uploads = []
+        if settings.SPLIT_UPLOADS:
+            batches, uploads = self._split_uploads(batches)
+        return ([partial(self._send_batch, batch, deadline=deadline)
+                 for batch in batches] +
+                [partial(self._send_upload, upload, deadline=deadline)
+                 for upload in uploads])
+
+    @staticmethod
+    def _split_uploads(batches):
+        """
+        Returns (batches, uploads) where heavy uploads have been taken out of
+        the batches into a list of (chinup, request).
+        """
+        split_batches, uploads = [], []
+        for chinups, requests in batches:
+            keep = []
+            for cu, req in zip(chinups, requests):
+                (uploads if is_heavy_upload(req) else keep).append((cu, req))
+            if keep:
+                split_batches.append(([cu for cu, _ in keep],
+                                      [req for _, req in keep]))
+        return split_batches, uploads
+
+    def _timeout(self, deadline):
+        """
+        Returns the (connect, read) timeout, shortened so as not to wait on
+        the connection past the deadline.
+        """
+        timeout = (settings.CONNECT_TIMEOUT, settings.READ_TIMEOUT)
+        if deadline is not None:
+            remaining = max(0.1, deadline - time.time())
+            timeout = tuple(remaining if t is None else min(t, remaining)
+                            for t in timeout)
+        return timeout
+
+    def _schedule_retries(self, chinups, e):
+        """
+        Schedules a retry for the chinups after their batch failed as a
+        whole, excepting chinups that were populated before the failure.
+        Returns False if the error isn't transient or they can't all be
+        retried, in which case the error should be raised.
+        """
+        policy = RetryPolicy.from_settings()
+        pending = [cu for cu in chinups if not cu.completed]
+        if not (policy and pending and policy.is_retryable_error(e) and
+                policy.schedule_all(pending)):
+            return False
+        logger.warning("Retrying %d requests after %s", len(pending), e)
+        return True
+
+    def _send_upload(self, upload, deadline=None):
+        chinup, request = upload
+        chinup._retry_at = None
+        logger.log(logging.INFO if settings.DEBUG_REQUESTS else logging.DEBUG,
+                   "Making upload request queue=%s", id(self))
+
+        if settings.THROTTLE:
+            get_throttle().wait(self.app_token, [request], deadline)
+            if deadline is not None and time.time() >= deadline:
+                return [chinup], [None]
+
+        try:
+            response = upload_request(self.app_token, request,
+                                      appsecret_proof=self.appsecret_proof,
+                                      timeout=self._timeout(deadline))
+        except BatchError as e:
+            if not self._schedule_retries([chinup], e):
+                raise
+            response = None
+        return [chinup], [response]
+
+    def _send_batch(self, batch, populate=False, deadline=None):
+        chinups, requests = batch
+        assert len(requests) <= 50
+        for cu in chinups:
+            cu._retry_at = None
+        logger.log(logging.INFO if settings.DEBUG_REQUESTS else logging.DEBUG,
+                   "Making batch request len=%s queue=%s",
+                   len(requests), id(self))
+
+        # With settings.STREAM_RESPONSES, chinups can be populated as soon as
+        # their responses arrive. Only do this on the calling thread though,
+        # since populating runs chinup callbacks.
+        on_response = None
+        if populate:
+            on_response = lambda i, r: self._populate([chinups[i]], [r])
+
+        # Slow down as Facebook reports usage approaching the rate limits.
+        # If that takes until the deadline, give up on the batch as if it
+        # timed out.
+        if settings.THROTTLE:
+            get_throttle().wait(self.app_token, requests, deadline)
+            if deadline is not None and time.time() >= deadline:
+                return chinups, [None] * len(chinups)
+
+        start = time.time()
+        try:
+            responses = batch_request(self.app_token, requests,
+                                      appsecret_proof=self.appsecret_proof,
+                                      on_response=on_response,
+                                      timeout=self._timeout(deadline))
+        except BatchError as e:
+            # Retry the whole batch after a transient failure, excepting
+            # chinups that were populated from a streamed response before
+            # the failure.
+            if not self._schedule_retries(chinups, e):
+                raise
+            return chinups, [None] * len(chinups)
+        if settings.ADAPTIVE_BATCHING:
+            get_packer().observe(requests, responses, time.time() - start)
+        return chinups, responses
+
+    def _populate(self, chinups, responses):
+        """
+        Populates responses into chinups.
+        """
+        policy = RetryPolicy.from_settings()
+        for cu, r in zip(chinups, responses):
+            # Streamed responses are populated or scheduled for a retry
+            # already.
+            if cu.completed or cu._retry_at is not None:
+                continue
+            # Don't set response for transient errors that will be retried
+            # in a later batch.
+            if policy and policy.is_retryable(r) and policy.schedule(cu):
+                continue
+            # Don't set response for timeouts, so they'll be automatically
+            # tried again when .data is accessed.
+            if r is not None:
+                cu.response = r
+            logger.log(logging.INFO if settings.DEBUG_REQUESTS else logging.DEBUG,
+                       '%s%r', 'TIMEOUT ' if r is None else '', cu)
+
     @classmethod
     def dedup(cls, chinups):
         """
-        Returns (uniques, dups) where the latter is a dict of lists indexed by
-        the former.
+        Returns (uniques, dups) where the latter is a dict of lists, each
+        starting with the corresponding unique chinup.
         """
         dups = OrderedDict()
         for c in chinups:
-            clist = dups.setdefault(c, [])
+            clist = dups.setdefault(cls._dedup_key(c), [])
             if clist:
                 logger.debug("Dedup %r", c)
             clist.append(c)
@@ -149,26 +768,114 @@ class ChinupQueue(object):
         logger.debug("Deduping reduced from %s to %s.", len(chinups), len(uniques))
         return uniques, dups
 
+    @classmethod
+    def coalesce(cls, chinups):
+        """
+        Returns (chinups, coalesced) where GETs of the same node that differ
+        only in their fields are replaced by a single chinup for the union of
+        the fields. The latter is a list of lists, each starting with the
+        replacement followed by the chinups it replaces.
+        """
+        groups = OrderedDict()  # key: [(union, members), ...]
+        placed = []  # chinup, or the group it's the first member of
+        for cu in chinups:
+            fields = requested_fields(cu)
+            key = fields and coalesce_key(cu)
+            if not key:
+                placed.append(cu)
+                continue
+            for union, members in groups.setdefault(key, []):
+                if union.add(fields):
+                    members.append((cu, fields))
+                    break
+            else:
+                group = (FieldUnion(), [(cu, fields)])
+                group[0].add(fields)
+                groups[key].append(group)
+                placed.append(group)
+
+        result, coalesced = [], []
+        for cu in placed:
+            if not isinstance(cu, tuple):
+                result.append(cu)
+                continue
+            union, members = cu
+            if len(members) == 1:
+                result.append(members[0][0])
+                continue
+            leader = members[0][0]
+            merged = leader._clone('GET', *merged_request(leader, union))
+            logger.debug("Coalesced %d requests into %r", len(members), merged)
+            result.append(merged)
+            coalesced.append([merged] + [m for m, _ in members])
+
+        logger.debug("Coalescing reduced from %s to %s.", len(chinups), len(result))
+        return result, coalesced
+
+    @classmethod
+    def uncoalesce(cls, coalesced):
+        """
+        Populates the responses of coalesced chinups into the chinups they
+        replaced, projected to the fields each of them requested. Returns the
+        replaced chinups of coalesced chinups that failed, which should be
+        sent separately.
+        """
+        failed = []
+        for clist in coalesced:
+            merged, members = clist[0], clist[1:]
+            if not merged.completed:
+                continue
+            merged._decode_response()
+            r = merged._response
+            if (merged._exception or not isinstance(r, dict) or
+                    r.get('code') != 200 or not isinstance(r.get('data'), dict)):
+                logger.debug("Coalesced request failed, uncoalescing %r", merged)
+                failed.extend(members)
+                continue
+            for cu in members:
+                cu.response = dict(r, data=project(r['data'],
+                                                   requested_fields(cu)))
+        return failed
+
+    @staticmethod
+    def _dedup_key(chinup):
+        """
+        Returns a key which is the same for chinups that are equal. This is
+        equivalent to Chinup.__eq__ but only uses the precomputed fingerprint.
+        Completed chinups are never considered duplicates.
+        """
+        if chinup.completed:
+            return id(chinup)
+        return (chinup.__class__, chinup.fingerprint, chinup.raise_exceptions)
+
     @classmethod
     def redup(cls, chinups, dups):
         """
         Returns full suite of chinups, integrating dups by setting their responses.
         """
-        for cu in chinups:
+        for clist in dups.values():
+            cu = clist[0]
             if not cu.completed:
                 continue
-            for i, dup in enumerate(dups[cu]):
-                if i == 0:
-                    assert dup is cu
-                else:
-                    assert not dup.completed
-                    dup.response = cu.response
+            for dup in clist[1:]:
+                assert not dup.completed
+                dup.response = cls._copy_response(cu._response)
         return [cu for v in dups.values() for cu in v]
 
+    @staticmethod
+    def _copy_response(response):
+        """
+        Returns a copy of a response for populating into another chinup.
+        Decoding the response body modifies the dict in place, and the
+        chinups might be decoded concurrently on different threads.
+        """
+        return dict(response) if isinstance(response, dict) else response
+
     def __getstate__(self):
-        d = dict(self.__dict__)
-        del d['chinups']
-        return d
+        # Private attributes such as locks are set up in __new__ for the
+        # per-token singleton, and don't belong in the pickle.
+        return {k: v for k, v in self.__dict__.items()
+                if k != 'chinups' and not k.startswith('_')}
 
     def __getnewargs__(self):
         return (self.app_token,)
@@ -177,7 +884,22 @@ class ChinupQueue(object):
         self.__dict__.update(d)
 
 
+def _capture(send, batch):
+    """
+    Sends the batch, returning (result, None), or (None, error) if it raised
+    an exception.
+    """
+    try:
+        return send(batch), None
+    except Exception as e:
+        return None, e
+
+
 def delete_queues():
+    """
+    Deletes the queues for the current thread. Shared queues are left alone,
+    since they might be in use by other threads.
+    """
     try:
         del _threadlocals.chinup_queues
     except AttributeError:
@@ -0,0 +1,158 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import random
+import time
+
+from .conf import settings
+from .exceptions import BatchFacebookError, BatchFacebookFail, TransportError
+from .util import from_json
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests are tried again, and when. A chinup is
+    retried when its response is a Facebook error with one of the codes or
+    subcodes, or when its batch as a whole failed with a TransportError, a
+    Facebook error with one of the codes or subcodes, or a server error, as
+    long as it has attempts left and its deadline, measured from the first
+    failure, hasn't passed. Chinups with attachments that can't be rewound
+    aren't retried, since they can't be sent again.
+
+    The delay before each retry grows exponentially from backoff up to
+    max_backoff, with jitter so that retries from many processes don't
+    arrive in lockstep. Rather than sleeping, the chinup is marked with the
+    time it's eligible again, and rejoins a later batch.
+    """
+    def __init__(self, codes=(), subcodes=(), max_attempts=0, backoff=1.0,
+                 max_backoff=60.0, deadline=None):
+        self.codes = frozenset(codes)
+        self.subcodes = frozenset(subcodes)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+    @classmethod
+    def from_settings(cls):
+        return cls(codes=settings.RETRY_CODES,
+                   subcodes=settings.RETRY_SUBCODES,
+                   max_attempts=settings.RETRY_MAX_ATTEMPTS,
+                   backoff=settings.RETRY_BACKOFF,
+                   max_backoff=settings.RETRY_MAX_BACKOFF,
+                   deadline=settings.RETRY_DEADLINE)
+
+    def __bool__(self):
+        return self.max_attempts > 0
+
+    __nonzero__ = __bool__  # Python 2
+
+    def is_retryable(self, response):
+        """
+        Returns True if the raw batch response is an error that should be
+        retried.
+        """
+        if not isinstance(response, dict) or response.get('code') == 200:
+            return False
+        try:
+            error = from_json(response['body'])['error']
+        except (KeyError, TypeError, ValueError):
+            return False
+        if not isinstance(error, dict):
+            return False
+        return (error.get('code') in self.codes or
+                error.get('error_subcode') in self.subcodes)
+
+    def is_retryable_error(self, e):
+        """
+        Returns True if the exception raised for a batch as a whole is one
+        that should be retried.
+        """
+        if isinstance(e, TransportError):
+            return True
+        if isinstance(e, BatchFacebookError):
+            return e.code in self.codes or e.subcode in self.subcodes
+        if isinstance(e, BatchFacebookFail):
+            return e.code is not None and e.code >= 500
+        return False
+
+    def delay(self, attempt):
+        """
+        Returns the number of seconds to wait before the given attempt,
+        counting from 1 for the first retry.
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def retry_at(self, chinup, now):
+        """
+        Returns the time at which the chinup would be retried, or None if it
+        has no attempts left, the retry would be past its deadline, or it
+        can't be sent again. The chinup isn't changed.
+        """
+        if chinup._attempts >= self.max_attempts or not can_resend(chinup):
+            return None
+        retry_at = now + self.delay(chinup._attempts + 1)
+        retry_deadline = chinup._retry_deadline
+        if retry_deadline is None and self.deadline is not None:
+            retry_deadline = now + self.deadline
+        for deadline in (retry_deadline, chinup.deadline):
+            if deadline is not None and retry_at > deadline:
+                return None
+        return retry_at
+
+    def schedule(self, chinup, now=None):
+        """
+        Schedules the chinup to be retried if it has attempts left, and
+        returns True if so.
+        """
+        return self.schedule_all([chinup], now)
+
+    def schedule_all(self, chinups, now=None):
+        """
+        Schedules all the chinups to be retried and returns True, or returns
+        False without scheduling any of them if one of them can't be.
+        """
+        now = time.time() if now is None else now
+        retry_ats = [self.retry_at(cu, now) for cu in chinups]
+        if None in retry_ats:
+            return False
+        for chinup, retry_at in zip(chinups, retry_ats):
+            if chinup._retry_deadline is None and self.deadline is not None:
+                chinup._retry_deadline = now + self.deadline
+            chinup._attempts += 1
+            chinup._retry_at = retry_at
+            logger.debug("Retry %d of %r in %.1fs", chinup._attempts, chinup,
+                         retry_at - now)
+        return True
+
+
+def can_resend(chinup):
+    """
+    Returns False if the chinup has attachments which can't be rewound to
+    send them again.
+    """
+    for value in (chinup.request['data'] or {}).values():
+        if not hasattr(value, 'read'):
+            continue
+        seekable = getattr(value, 'seekable', None)
+        try:
+            if callable(seekable) and not seekable():
+                return False
+            value.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+    return True
+
+
+def is_waiting(chinup, now):
+    """
+    Returns True if the chinup is scheduled for a retry that isn't due yet.
+    """
+    return chinup._retry_at is not None and chinup._retry_at > now
+
+
+__all__ = ['RetryPolicy']
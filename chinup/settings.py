@@ -15,3 +15,39 @@ DEDUP = True
 MIGRATIONS = {}
 RELATIVE_URL_HOOK = None
 SUMMARY_INFO = True
+HTTP_POOL_SIZE = 10
+HTTP_KEEPALIVE = True
+CONCURRENT_BATCHES = 1
+SHARED_QUEUE = False
+STREAM_RESPONSES = False
+JSON_CODEC = 'json'
+JSON_DECIMAL = False
+ETAGS_METHODS = ['GET']
+ETAGS_PATHS = None
+ETAGS_LOCAL_ENTRIES = 1000
+ETAGS_LOCAL_BYTES = 10 * 1024 * 1024
+RESPONSE_CACHE_TTLS = []
+ETAGS_MAX_ENTRY_BYTES = 1000 * 1000
+ADAPTIVE_BATCHING = False
+BATCH_TIME_BUDGET = 25.0
+BATCH_MAX_BYTES = 10 * 1024 * 1024
+RETRY_MAX_ATTEMPTS = 0
+RETRY_CODES = [1, 2, 4, 17, 341, 613]
+RETRY_SUBCODES = []
+RETRY_BACKOFF = 1.0
+RETRY_MAX_BACKOFF = 60.0
+RETRY_DEADLINE = 300
+THROTTLE = False
+THROTTLE_THRESHOLD = 75
+THROTTLE_RATE = 2.0
+THROTTLE_BURST = 5
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 300
+INCLUDE_HEADERS = None
+INCLUDE_HEADERS_PATHS = [r'/picture$']
+STREAM_UPLOADS = False
+SPLIT_UPLOADS = False
+UPLOAD_URL = 'https://graph-video.facebook.com'
+UPLOAD_SPLIT_BYTES = 1024 * 1024
+UPLOAD_CONCURRENCY = 2
+COALESCE_FIELDS = False
@@ -0,0 +1,308 @@
+"""
+Throttling of batch dispatch according to the usage headers that Facebook
+returns with responses:
+
+    X-App-Usage: {"call_count": 28, "total_time": 25, "total_cputime": 25}
+    X-Ad-Account-Usage: {"acc_id_util_pct": 9.67, "reset_time_duration": 0}
+    X-Business-Use-Case-Usage: {"123": [{"type": "ads_insights",
+        "call_count": 95, "total_cputime": 20, "total_time": 20,
+        "estimated_time_to_regain_access": 0}]}
+
+Usage is kept per app, per ad account or business, and per user token, as
+the percentage of the corresponding rate limit. Ad accounts and businesses
+are both identified by their numeric id, without the act_ prefix. The
+business usage reported for a request is also linked to the node it
+requested, so that later requests for the node are throttled along with
+the business. Batches for an app token are
+dispatched freely while usage is below settings.THROTTLE_THRESHOLD, then
+through a token bucket whose rate falls as usage approaches 100%.
+"""
+from __future__ import absolute_import, unicode_literals
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import threading
+import time
+
+from urlobject import URLObject as URL
+
+from .conf import settings
+from .util import from_json
+
+
+logger = logging.getLogger(__name__)
+
+
+# Usage reports older than this many seconds are ignored.
+USAGE_TTL = 300
+
+# Number of scopes to keep usage for, least recently updated are forgotten
+# first.
+MAX_SCOPES = 10000
+
+# The slowest rate, as a fraction of settings.THROTTLE_RATE, so that usage
+# reports keep coming in.
+MIN_RATE_FRACTION = 0.02
+
+# The longest that dispatch of one batch is delayed.
+MAX_DELAY = 60
+
+_account_path = re.compile(r'(?:^|/)act_(\d+)(?:/|$)')
+_node_path = re.compile(r'^/?(?:v\d+\.\d+/)?(\d+)(?:_\d+)?(?:/|$)')
+
+
+def parse_usage(name, value):
+    """
+    Returns a list of (scope, percent, regain) from a usage header, where
+    scope is None for the scope implied by the request, or the id of an
+    ad account or business. regain is the number of seconds until access is
+    regained if throttled, otherwise 0.
+    """
+    try:
+        usage = from_json(value)
+    except ValueError:
+        logger.debug("Ignoring unparseable %s: %r", name, value)
+        return []
+    if not isinstance(usage, dict):
+        return []
+
+    name = name.lower()
+    if name == 'x-app-usage':
+        return [(None, _max_pct(usage), 0)]
+
+    if name == 'x-ad-account-usage':
+        return [(None, float(usage.get('acc_id_util_pct') or 0),
+                 float(usage.get('reset_time_duration') or 0))]
+
+    if name == 'x-business-use-case-usage':
+        result = []
+        for scope, uses in usage.items():
+            if not isinstance(uses, list):
+                continue
+            for use in uses:
+                result.append((account_id(scope), _max_pct(use), 60 * float(
+                    use.get('estimated_time_to_regain_access') or 0)))
+        return result
+
+    return []
+
+
+def account_id(scope):
+    """
+    Returns the id of an ad account or business without the act_ prefix,
+    which Facebook includes in some places but not others.
+    """
+    scope = '{}'.format(scope)
+    return scope[4:] if scope.startswith('act_') else scope
+
+
+def _max_pct(usage):
+    return float(max(usage.get(k) or 0 for k in
+                     ('call_count', 'total_cputime', 'total_time')))
+
+
+USAGE_HEADERS = ('x-app-usage', 'x-ad-account-usage',
+                 'x-business-use-case-usage')
+
+
+def request_scopes(request):
+    """
+    Returns the scopes that usage of a batched request counts against,
+    besides the app: its access token, its ad account if any, and the node
+    it requests if that's a numeric id.
+    """
+    url = URL(request['relative_url'])
+    scopes = []
+    token = url.query_dict.get('access_token')
+    if token:
+        scopes.append(('token', token))
+    m = _account_path.search(url.path)
+    if m:
+        scopes.append(('account', m.group(1)))
+    else:
+        m = _node_path.match(url.path)
+        if m:
+            scopes.append(('node', m.group(1)))
+    return scopes
+
+
+class UsageModel(object):
+    """
+    Latest reported usage per scope, where a scope is a tuple such as
+    ('app', app_token), ('token', token) or ('account', '123'). Scopes of
+    requests, such as ('node', '456'), are linked to the businesses whose
+    usage was reported for them.
+    """
+    def __init__(self):
+        self._usage = OrderedDict()  # scope: (percent, regain_at, updated)
+        self._links = OrderedDict()  # scope: set of account scopes
+        self._lock = threading.Lock()
+
+    def link(self, scope, account):
+        with self._lock:
+            accounts = self._links.pop(scope, set())
+            accounts.add(account)
+            self._links[scope] = accounts
+            while len(self._links) > MAX_SCOPES:
+                self._links.popitem(last=False)
+
+    def update(self, scope, percent, regain=0, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._usage.pop(scope, None)
+            self._usage[scope] = percent, now + regain if regain else 0, now
+            while len(self._usage) > MAX_SCOPES:
+                self._usage.popitem(last=False)
+
+    def get(self, scopes, now=None):
+        """
+        Returns (percent, regain_at) for the most used of the scopes.
+        """
+        now = time.time() if now is None else now
+        percent, regain_at = 0.0, 0
+        with self._lock:
+            scopes = set(scopes)
+            for scope in list(scopes):
+                scopes.update(self._links.get(scope, ()))
+            for scope in scopes:
+                u = self._usage.get(scope)
+                if u and u[2] > now - USAGE_TTL:
+                    percent = max(percent, u[0])
+                    regain_at = max(regain_at, u[1])
+        return percent, regain_at
+
+    def observe(self, app_token, headers, requests, responses):
+        """
+        Records usage from the headers of a batch response, which count
+        against the app, and from the headers of each response in the batch,
+        which count against the token and account of its request.
+        """
+        for name in USAGE_HEADERS:
+            value = headers.get(name)
+            if value:
+                for scope, percent, regain in parse_usage(name, value):
+                    self.update(('app', app_token) if scope is None else
+                                ('account', scope), percent, regain)
+
+        for request, response in zip(requests, responses):
+            if not isinstance(response, dict):
+                continue
+            for h in response.get('headers') or ():
+                if h['name'].lower() not in USAGE_HEADERS:
+                    continue
+                usages = parse_usage(h['name'], h['value'])
+                if not usages:
+                    continue
+                scopes = request_scopes(request)
+                for scope, percent, regain in usages:
+                    if h['name'].lower() == 'x-business-use-case-usage':
+                        targets = [('account', scope)]
+                        for s in scopes:
+                            if s[0] != 'token' and s != targets[0]:
+                                self.link(s, targets[0])
+                    elif h['name'].lower() == 'x-ad-account-usage':
+                        targets = [s for s in scopes if s[0] == 'account']
+                    else:
+                        targets = [s for s in scopes if s[0] == 'token']
+                    for target in targets:
+                        self.update(target, percent, regain)
+
+
+class TokenBucket(object):
+    """
+    Token bucket which goes into debt rather than refusing, returning how
+    long the caller should wait for its token.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self, rate, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            self.tokens -= 1
+            return -self.tokens / rate if self.tokens < 0 else 0
+
+
+class Throttle(object):
+    """
+    Usage model and per-app token buckets, shared by all queues in the
+    process.
+    """
+    def __init__(self):
+        self.usage = UsageModel()
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, app_token):
+        with self._lock:
+            bucket = self._buckets.get(app_token)
+            if bucket is None:
+                bucket = self._buckets[app_token] = TokenBucket(
+                    settings.THROTTLE_BURST)
+            return bucket
+
+    def delay(self, app_token, requests, now=None):
+        """
+        Returns the number of seconds to wait before dispatching a batch of
+        the requests.
+        """
+        now = time.time() if now is None else now
+        scopes = set([('app', app_token)])
+        for request in requests:
+            scopes.update(request_scopes(request))
+        percent, regain_at = self.usage.get(scopes, now)
+
+        threshold = settings.THROTTLE_THRESHOLD
+        if percent < threshold:
+            return 0
+
+        fraction = (100.0 - min(percent, 100)) / (100 - threshold)
+        rate = settings.THROTTLE_RATE * max(MIN_RATE_FRACTION, fraction)
+        delay = max(self._bucket(app_token).take(rate, now), regain_at - now)
+        logger.debug("Usage %.0f%%, delaying batch %.1fs", percent, delay)
+        return min(delay, MAX_DELAY)
+
+    def wait(self, app_token, requests, deadline=None):
+        """
+        Sleeps before dispatching a batch of the requests, but not past the
+        deadline, if any.
+        """
+        delay = self.delay(app_token, requests)
+        if deadline is not None:
+            delay = min(delay, deadline - time.time())
+        if delay > 0:
+            logger.info("Throttling batch for %.1fs", delay)
+            time.sleep(delay)
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle():
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = Throttle()
+        return _throttle
+
+
+def _after_fork():
+    global _throttle, _throttle_lock
+    _throttle_lock = threading.Lock()
+    _throttle = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+__all__ = ['Throttle', 'TokenBucket', 'UsageModel', 'account_id',
+           'get_throttle', 'parse_usage']
@@ -1,5 +1,8 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import namedtuple
+from decimal import Decimal
+from functools import partial
 import hmac
 import hashlib
 import json
@@ -12,6 +15,14 @@ import sys
 logger = logging.getLogger(__name__)
 
 
+try:
+    basestring = basestring
+    unicode = unicode
+except NameError:
+    # Python 3
+    basestring = unicode = str
+
+
 def partition(cond, seq, parts=2):
     """
     Partition function from Erik Wilsher on Ned's blog at
@@ -51,17 +62,114 @@ def as_json(data):
     """
     Consistent JSON dumping, with key sorting for test stability.
     """
-    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return get_json_codec().dumps(data)
+
+
+def from_json(s, decimal=False):
+    """
+    JSON loading with the configured codec, optionally decoding floats as
+    Decimal.
+    """
+    codec = get_json_codec()
+    return (codec.loads_decimal if decimal else codec.loads)(s)
+
+
+JSONCodec = namedtuple('JSONCodec', 'dumps loads loads_decimal')
+
+
+def _stdlib_json_codec(module):
+    return JSONCodec(
+        dumps=partial(module.dumps, sort_keys=True, separators=(',', ':')),
+        loads=module.loads,
+        loads_decimal=partial(module.loads, parse_float=Decimal))
+
+
+def _simplejson_codec():
+    import simplejson
+    return _stdlib_json_codec(simplejson)
+
+
+def _ujson_codec():
+    import ujson
+    return JSONCodec(
+        dumps=partial(ujson.dumps, sort_keys=True, ensure_ascii=False,
+                      escape_forward_slashes=False),
+        loads=ujson.loads,
+        # ujson can't decode to Decimal.
+        loads_decimal=partial(json.loads, parse_float=Decimal))
+
+
+def _orjson_codec():
+    import orjson
+    def dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+    return JSONCodec(
+        dumps=dumps,
+        loads=orjson.loads,
+        # orjson can't decode to Decimal.
+        loads_decimal=partial(json.loads, parse_float=Decimal))
+
+
+def _rapidjson_codec():
+    import rapidjson
+    return JSONCodec(
+        dumps=partial(rapidjson.dumps, sort_keys=True, ensure_ascii=False),
+        loads=rapidjson.loads,
+        loads_decimal=partial(rapidjson.loads,
+                              number_mode=rapidjson.NM_DECIMAL))
+
+
+json_codecs = {
+    'json': partial(_stdlib_json_codec, json),
+    'simplejson': _simplejson_codec,
+    'ujson': _ujson_codec,
+    'orjson': _orjson_codec,
+    'rapidjson': _rapidjson_codec,
+}
+
+_json_codecs = {}
+
+
+def get_json_codec():
+    """
+    Returns the JSONCodec for settings.JSON_CODEC. The alternative backends
+    are optional dependencies, so they're imported on first use.
+    """
+    from .conf import settings
+    name = settings.JSON_CODEC
+    try:
+        return _json_codecs[name]
+    except KeyError:
+        codec = _json_codecs[name] = json_codecs[name]()
+        return codec
+
+
+_proofs = {}
 
 
 def get_proof(key, msg):
     """
     Returns appsecret_proof, see
     https://developers.facebook.com/docs/graph-api/securing-requests
+
+    Proofs are cached for each (key, msg) pair, since the same secret and
+    token are typically used for many requests.
     """
-    if isinstance(key, unicode):
-        key = key.encode('utf-8')
-    if isinstance(msg, unicode):
-        msg = msg.encode('utf-8')
-    h = hmac.new(key, msg, hashlib.sha256)
-    return h.hexdigest()
+    try:
+        return _proofs[key, msg]
+    except KeyError:
+        pass
+
+    bkey, bmsg = key, msg
+    if isinstance(bkey, unicode):
+        bkey = bkey.encode('utf-8')
+    if isinstance(bmsg, unicode):
+        bmsg = bmsg.encode('utf-8')
+    h = hmac.new(bkey, bmsg, hashlib.sha256)
+    proof = h.hexdigest()
+
+    # Keep the cache bounded.
+    if len(_proofs) >= 1000:
+        _proofs.clear()
+    _proofs[key, msg] = proof
+    return proof